@@ -0,0 +1,57 @@
+import threading
+import time
+import traceback
+
+from config import *
+
+
+class AcquisitionThread(threading.Thread):
+    """
+    Consumes the ring buffer independently of the GUI.
+
+    Polls get_total_count_fn and calls every callback with (buf, produced),
+    where produced is the total number of values transferred so far
+    (see ring_buffer).
+    This way storage doesn't depend on the frame rate of the visualization
+    (slow frames, dragging the window, correlation updates...).
+    Every consumer has its own RingReader, so storage and analysis run in
+    separate threads and a slow analysis doesn't delay writing to disk.
+
+    Exceptions of a callback are printed and passed to
+    error_fn(callback_fn, exception), which is called with the lock held
+    (e.g. to stop the measurement). Without error_fn, the failing callback
+    is not called anymore.
+
+    Hold lock while changing state the callbacks rely on
+    (e.g. toggling an acquisition).
+    """
+
+    def __init__(self, buf, get_total_count_fn, callbacks, interval=0.01, error_fn=None, name=None):
+        threading.Thread.__init__(self, daemon=True, name=name)
+        self.buf = buf
+        self.get_total_count_fn = get_total_count_fn
+        self.callbacks = list(callbacks)
+        self.interval = interval
+        self.error_fn = error_fn
+        self.lock = threading.RLock()
+        self.stop = False
+
+    def run(self):
+        while not self.stop:
+            produced = self.get_total_count_fn()
+            # transfer of one channel may be ahead, reading that sample next time
+            produced -= produced % CHANNELS
+
+            with self.lock:
+                for callback_fn in list(self.callbacks):
+                    try:
+                        callback_fn(self.buf, produced)
+                    except Exception as e:
+                        print(f"Error in {self.name}:")
+                        traceback.print_exc()
+                        if self.error_fn is not None:
+                            self.error_fn(callback_fn, e)
+                        else:
+                            self.callbacks.remove(callback_fn)
+
+            time.sleep(self.interval)
@@ -0,0 +1,368 @@
+"""
+Burst search on photon streams (sorted int64 timestamps and detectors,
+e.g. from correlate.load_hdf5, load_csv or iter_hdf5).
+
+Sliding-window rate-threshold search: a window of m consecutive photons
+qualifies if it spans at most max_duration (in units of the timestamps),
+i.e. if the rate of the window is above (m - 1) / max_duration. A burst
+consists of the photons of a series of qualifying windows sharing photons.
+
+- All-photon burst search (BurstSearch) searches all photons given.
+- Dual-channel burst search (DualChannelBurstSearch) searches the donor
+  and the acceptor photons separately; bursts are the times in a burst of
+  both channels, containing the photons of both channels in that time.
+
+The searches are fed consecutive chunks of photons (add) and carry their
+state across chunk boundaries, so long measurements are searched with
+bounded memory. Bursts are returned as soon as they are finished, as
+compact structured arrays (see BURST_DTYPE).
+"""
+
+import threading
+
+import numba
+import numpy as np
+
+# first and last photon (timestamps), number of photons, of them from donor and acceptor
+BURST_DTYPE = np.dtype([('start', np.int64), ('stop', np.int64), ('size', np.int64),
+                        ('donor', np.int64), ('acceptor', np.int64)])
+
+_FIELDS = len(BURST_DTYPE.names)
+
+
+def max_window_duration(m, rate, clk):
+    """
+    Longest duration (in timestamp units of clk seconds) of a window
+    of m photons with a rate of at least rate (photons/s).
+    """
+    return int((m - 1) / (rate * clk))
+
+
+def proximity_ratio(bursts):
+    """
+    Proximity ratio E = acceptor / (donor + acceptor) of bursts.
+    """
+    total = bursts['donor'] + bursts['acceptor']
+    return bursts['acceptor'] / np.maximum(total, 1)
+
+
+def _to_bursts(out):
+    """
+    View rows of out (one burst each) as BURST_DTYPE array.
+    """
+    return np.ascontiguousarray(out).view(BURST_DTYPE)[:, 0]
+
+
+@numba.jit(nopython=True, nogil=True)
+def _search(t, dets, m, max_duration, min_size, donor, acceptor, last, state, out):
+    """
+    Searches bursts in photons t, dets (continuing the photons before).
+
+    Photon i is processed together with the window starting at it, so the
+    last m - 1 photons are only processed with the next chunk (or if last).
+    state holds (index of t[0], in burst, index of the last photon of
+    the burst, and start, stop, size, donor and acceptor photons of
+    the burst) and is updated. Finished bursts with at least min_size
+    photons are written to out, returns their number.
+    """
+    first = state[0]
+    in_burst = state[1] != 0
+    covered = state[2]
+    start, stop, size, n_donor, n_acceptor = state[3], state[4], state[5], state[6], state[7]
+
+    windows = t.size - m + 1
+    photons = t.size if last else max(windows, 0)
+    k = 0
+    for i in range(photons):
+        idx = first + i
+        if in_burst and idx > covered:
+            # no window containing photons of the burst is left
+            if size >= min_size:
+                out[k, 0], out[k, 1], out[k, 2], out[k, 3], out[k, 4] = start, stop, size, n_donor, n_acceptor
+                k += 1
+            in_burst = False
+        if i < windows and t[i + m - 1] - t[i] <= max_duration:
+            if not in_burst:
+                in_burst = True
+                start = t[i]
+                size, n_donor, n_acceptor = 0, 0, 0
+            covered = idx + m - 1
+            stop = t[i + m - 1]
+        if in_burst:
+            size += 1
+            if dets[i] == donor:
+                n_donor += 1
+            elif dets[i] == acceptor:
+                n_acceptor += 1
+    if last and in_burst:
+        if size >= min_size:
+            out[k, 0], out[k, 1], out[k, 2], out[k, 3], out[k, 4] = start, stop, size, n_donor, n_acceptor
+            k += 1
+        in_burst = False
+
+    state[0] = first + photons
+    state[1] = in_burst
+    state[2] = covered
+    state[3], state[4], state[5], state[6], state[7] = start, stop, size, n_donor, n_acceptor
+    return k
+
+
+@numba.jit(nopython=True, nogil=True)
+def _intersect(a, b, out):
+    """
+    Intersects the sorted, disjoint intervals (start, stop) of a and b,
+    intersections touching each other are joined. Returns their number.
+    """
+    i, j, k = 0, 0, 0
+    while i < a.shape[0] and j < b.shape[0]:
+        lo = max(a[i, 0], b[j, 0])
+        hi = min(a[i, 1], b[j, 1])
+        if lo <= hi:
+            if k > 0 and lo <= out[k-1, 1]:
+                out[k-1, 1] = max(out[k-1, 1], hi)
+            else:
+                out[k, 0] = lo
+                out[k, 1] = hi
+                k += 1
+        if a[i, 1] < b[j, 1]:
+            i += 1
+        else:
+            j += 1
+    return k
+
+
+@numba.jit(nopython=True, nogil=True)
+def _split(times, dets, donor, acceptor):
+    """
+    Returns the times of the donor and of the acceptor photons.
+    """
+    n_donor, n_acceptor = 0, 0
+    for d in dets:
+        if d == donor:
+            n_donor += 1
+        elif d == acceptor:
+            n_acceptor += 1
+    donor_times = np.empty(n_donor, dtype=np.int64)
+    acceptor_times = np.empty(n_acceptor, dtype=np.int64)
+    n_donor, n_acceptor = 0, 0
+    for i in range(times.size):
+        if dets[i] == donor:
+            donor_times[n_donor] = times[i]
+            n_donor += 1
+        elif dets[i] == acceptor:
+            acceptor_times[n_acceptor] = times[i]
+            n_acceptor += 1
+    return donor_times, acceptor_times
+
+
+class BurstSearch():
+    """
+    All-photon burst search over consecutive chunks of photons.
+
+    max_duration is the longest span of m photons in a burst
+    (see max_window_duration), bursts with less than min_size photons are
+    dropped. Photons of the donor and acceptor detectors are counted per burst.
+    """
+
+    def __init__(self, max_duration, m=10, min_size=30, donor=0, acceptor=1):
+        self.max_duration = max_duration
+        self.m = m
+        self.min_size = min_size
+        self.donor = donor
+        self.acceptor = acceptor
+        self.state = np.zeros(8, dtype=np.int64)
+        # photons not processed yet (the last m - 1)
+        self.times = np.zeros(0, dtype=np.int64)
+        self.dets = np.zeros(0, dtype=np.uint8)
+
+    def _run(self, times, dets, last):
+        if times.size > 0:
+            times = np.concatenate((self.times, times))
+            dets = np.concatenate((self.dets, dets))
+        else:
+            times, dets = self.times, self.dets
+        first = self.state[0]
+        out = np.empty((times.size // self.m + 2, _FIELDS), dtype=np.int64)
+        k = _search(times, dets, self.m, self.max_duration, self.min_size,
+                    self.donor, self.acceptor, last, self.state, out)
+        processed = self.state[0] - first
+        self.times, self.dets = times[processed:], dets[processed:]
+        return _to_bursts(out[:k])
+
+    def add(self, times, dets):
+        """
+        Searches the next chunk of photons (times not before the ones added
+        so far). Returns the bursts finished by it.
+        """
+        return self._run(np.asarray(times, dtype=np.int64), np.asarray(dets), False)
+
+    def finish(self):
+        """
+        Ends the stream, returns the remaining bursts.
+        """
+        return self._run(np.zeros(0, dtype=np.int64), self.dets[:0], True)
+
+    def frontier(self, last_time):
+        """
+        Time before which no further burst can start, given that the stream
+        is complete up to last_time.
+        """
+        if self.state[1]:
+            return self.state[3]
+        if self.times.size > 0:
+            # windows starting at the unprocessed photons end after last_time
+            return max(self.times[0], last_time - self.max_duration)
+        return last_time
+
+
+class DualChannelBurstSearch():
+    """
+    Dual-channel burst search over consecutive chunks of photons.
+
+    Searches the donor and the acceptor photons separately (parameters as for
+    BurstSearch, the same for both channels) and returns the photons of both
+    channels in the times that are in a burst of both channels, if there are
+    at least min_size of them.
+    """
+
+    def __init__(self, max_duration, m=10, min_size=30, donor=0, acceptor=1):
+        self.min_size = min_size
+        self.donor = donor
+        self.acceptor = acceptor
+        self.channels = (donor, acceptor)
+        self.searches = [BurstSearch(max_duration, m, 0, donor, acceptor) for _ in range(2)]
+        # bursts (start, stop) of the channels that may still intersect later ones
+        self.intervals = [np.zeros((0, 2), dtype=np.int64) for _ in range(2)]
+        # photons of the channels that may still be part of a burst
+        self.times = [np.zeros(0, dtype=np.int64) for _ in range(2)]
+        self.last_time = 0
+
+    def _run(self, times, dets, last):
+        if times.size > 0:
+            self.last_time = times[-1]
+        for c, channel_times in enumerate(_split(times, dets, *self.channels)):
+            self.times[c] = np.concatenate((self.times[c], channel_times))
+            if last:
+                bursts = self.searches[c].finish()
+            else:
+                bursts = self.searches[c].add(channel_times, np.full(channel_times.size, self.channels[c], dtype=np.uint8))
+            self.intervals[c] = np.concatenate((self.intervals[c], np.stack((bursts['start'], bursts['stop']), axis=1)))
+
+        if last:
+            frontier = np.iinfo(np.int64).max
+        else:
+            frontier = min(search.frontier(self.last_time) for search in self.searches)
+
+        a, b = self.intervals
+        out = np.empty((a.shape[0] + b.shape[0], 2), dtype=np.int64)
+        k = _intersect(a, b, out)
+        # intersections ending before the frontier can't grow anymore
+        finished = np.searchsorted(out[:k, 1], frontier)
+        limit = frontier if finished == k else min(frontier, out[finished, 0])
+
+        bursts = np.empty((finished, _FIELDS), dtype=np.int64)
+        bursts[:, 0:2] = out[:finished]
+        for c in range(2):
+            lo = np.searchsorted(self.times[c], bursts[:, 0], side='left')
+            hi = np.searchsorted(self.times[c], bursts[:, 1], side='right')
+            bursts[:, 3 + c] = hi - lo
+        bursts[:, 2] = bursts[:, 3] + bursts[:, 4]
+        bursts = bursts[bursts[:, 2] >= self.min_size]
+
+        # keep what later intersections can be made of
+        self.intervals = [i[i[:, 1] >= limit] for i in self.intervals]
+        keep_from = min([limit] + [i[0, 0] for i in self.intervals if i.shape[0] > 0])
+        self.times = [t[np.searchsorted(t, keep_from):] for t in self.times]
+        return _to_bursts(bursts)
+
+    def add(self, times, dets):
+        """
+        Searches the next chunk of photons (times not before the ones added
+        so far). Returns the bursts finished by it.
+        """
+        return self._run(np.asarray(times, dtype=np.int64), np.asarray(dets), False)
+
+    def finish(self):
+        """
+        Ends the stream, returns the remaining bursts.
+        """
+        return self._run(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), True)
+
+
+class BurstHistograms():
+    """
+    Histograms of the sizes and proximity ratios of all bursts added so far,
+    e.g. from the acquisition thread while the GUI draws them.
+    Memory is fixed: sizes above max_size end up in the last size bin.
+    """
+
+    def __init__(self, max_size=300, size_bin=5, ratio_bins=40):
+        self.size_bin = size_bin
+        self.size_edges = np.arange(0, max_size + size_bin, size_bin)
+        self.ratio_edges = np.linspace(0, 1, ratio_bins + 1)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all bursts added so far.
+        """
+        with self.lock:
+            self.sizes = np.zeros(self.size_edges.size - 1, dtype=np.int64)
+            self.ratios = np.zeros(self.ratio_edges.size - 1, dtype=np.int64)
+
+    def add(self, bursts):
+        if bursts.size == 0:
+            return
+        size_bins = np.minimum(bursts['size'] // self.size_bin, self.sizes.size - 1)
+        ratio_bins = np.minimum((proximity_ratio(bursts) * self.ratios.size).astype(np.int64), self.ratios.size - 1)
+        sizes = np.bincount(size_bins, minlength=self.sizes.size)
+        ratios = np.bincount(ratio_bins, minlength=self.ratios.size)
+        with self.lock:
+            self.sizes += sizes
+            self.ratios += ratios
+
+    def histograms(self):
+        """
+        Returns copies of the size and the proximity ratio histogram.
+        """
+        with self.lock:
+            return self.sizes.copy(), self.ratios.copy()
+
+
+def find_bursts(times, dets, max_duration, m=10, min_size=30, dual_channel=False,
+                donor=0, acceptor=1, chunk_size=int(1e7)):
+    """
+    Search bursts in a photon stream.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        Arrival times of photons (sorted).
+    dets : np.ndarray
+        Detectors of photons.
+    max_duration : int
+        Longest span of m photons in a burst (see max_window_duration).
+    m : int, optional
+        Number of photons per window. The default is 10.
+    min_size : int, optional
+        Minimum number of photons per burst. The default is 30.
+    dual_channel : bool, optional
+        Dual-channel instead of all-photon burst search. The default is False.
+    donor, acceptor : int, optional
+        Detectors of donor and acceptor. The defaults are 0 and 1.
+    chunk_size : int, optional
+        Photons searched at a time. The default is int(1e7).
+
+    Returns
+    -------
+    bursts : np.ndarray[BURST_DTYPE]
+        start and stop time, size and donor and acceptor photons of the bursts.
+
+    """
+    search_class = DualChannelBurstSearch if dual_channel else BurstSearch
+    search = search_class(max_duration, m, min_size, donor, acceptor)
+    bursts = [search.add(times[start:start+chunk_size], dets[start:start+chunk_size])
+              for start in range(0, times.size, chunk_size)]
+    bursts.append(search.finish())
+    return np.concatenate(bursts)
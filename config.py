@@ -41,6 +41,11 @@ class Config(object):
         self.config['acquisition_rate'] = int(self.config['acquisition_rate'])
         self.config['bin_size'] = int(self.config['bin_size'])
         self.config['buffer_size'] = int(self.config['buffer_size'])
+        # Added later, older config files don't have it
+        self.config.setdefault('chunk_seconds', 0.1)
+        self.config.setdefault('history_seconds', 600)
+        self.config.setdefault('burst_rate', 10e3)
+        self.config.setdefault('burst_min_size', 30)
 
 def get_config():
     return Config().config
@@ -55,7 +60,12 @@ ACQUISITION_RATE = get_config()['acquisition_rate']
 BUFFER_SIZE = get_config()['buffer_size']
 CANVAS_SIZE = (get_config()['canvas_width'], get_config()['canvas_height'])
 BIN_SIZE = get_config()['bin_size']
+HISTORY_SECONDS = get_config()['history_seconds']
+BURST_RATE = float(get_config()['burst_rate'])
+BURST_MIN_SIZE = int(get_config()['burst_min_size'])
 
 # derived values:
 PLAIN_BUFFER_SIZE = BUFFER_SIZE * CHANNELS
 SAMPLES_PER_BIN = ACQUISITION_RATE // BIN_SIZE
+# Minimum amount of values handed to storage at once (at most half the buffer)
+MIN_CHUNK_SIZE = min(max(int(get_config()['chunk_seconds'] * ACQUISITION_RATE), 1) * CHANNELS, PLAIN_BUFFER_SIZE // 2)
@@ -6,6 +6,8 @@ Created on Thu Jun  6 10:39:28 2024
 @author: paul
 """
 
+import threading
+
 import numpy as  np
 import numba
 import tables as tb
@@ -13,6 +15,10 @@ import tables as tb
 from vispy import scene, app
 
 import config
+from raw_file import load_raw
+from read_csv import load_csv_table
+from traces import TraceBuilder, load_stored_trace
+from lod import LODPyramid, LODPlot, lod_filename
 
 @numba.jit(numba.float64[:](numba.float64[:], numba.int64[:], numba.int64[:], numba.int64[:]), nopython=True)
 def pnormalize(G, t, u, bins):
@@ -33,8 +39,10 @@ def pnormalize(G, t, u, bins):
 
     Arguments:
         G (array): raw cross-correlation to be normalized.
-        t (array): first input array of "points" used to compute `G`.
-        u (array): second input array of "points" used to compute `G`.
+        t (array): first input array of "points" used to compute `G`,
+            monothonically increasing.
+        u (array): second input array of "points" used to compute `G`,
+            monothonically increasing.
         bins (array): array of bins used to compute `G`. Needs to have the
             same units as input arguments `t` and `u`.
 
@@ -42,15 +50,64 @@ def pnormalize(G, t, u, bins):
         Array of normalized values for the cross-correlation function,
         same size as the input argument `G`.
     """
-    duration = max((t.max(), u.max())) - min((t.min(), u.min()))
+    if t.size == 0 or u.size == 0:
+        # like max() of an empty array, t[-1] isn't bounds checked
+        raise ValueError("pnormalize: t and u must not be empty")
+    # t and u are sorted, so the counts are found by binary search
+    t_max, u_max = t[-1], u[-1]
+    duration = max((t_max, u_max)) - min((t[0], u[0]))
     Gn = G.copy()
     for i, tau in enumerate(bins[1:]):
         Gn[i] *= ((duration - tau) /
-                  (float((t >= tau).sum()) *
-                   float((u <= (u.max() - tau)).sum())))
+                  (float(t.size - np.searchsorted(t, tau, side='left')) *
+                   float(np.searchsorted(u, u_max - tau, side='right'))))
     return Gn
 
 
+@numba.jit(numba.int64[:](numba.int64[:], numba.int64[:], numba.int64[:]), nopython=True, nogil=True)
+def _pcorrelate_counts(t, u, bins):
+    """
+    Internal function counting the pairs of `t` and `u` per lag bin,
+    the unnormalized part of :func:`pcorrelate`.
+    """
+    nbins = len(bins) - 1
+
+    # Array of counts (histogram)
+    counts = np.zeros(nbins, dtype=np.int64)
+
+    # For each bins, imin is the index of first `u` >= of each left bin edge
+    imin = np.zeros(nbins, dtype=np.int64)
+    # For each bins, imax is the index of first `u` >= of each right bin edge
+    imax = np.zeros(nbins, dtype=np.int64)
+
+    # For each ti, perform binning of (u - ti) and accumulate counts in Y
+    for ti in t:
+        for k, (tau_min, tau_max) in enumerate(zip(bins[:-1], bins[1:])):
+            #print ('\nbin %d' % k)
+
+            if k == 0:
+                j = imin[k]
+                # We start by finding the index of the first `u` element
+                # which is >= of the first bin edge `tau_min`
+                while j < len(u):
+                    if u[j] - ti >= tau_min:
+                        break
+                    j += 1
+
+            imin[k] = j
+            if imax[k] > j:
+                j = imax[k]
+            while j < len(u):
+                if u[j] - ti >= tau_max:
+                    break
+                j += 1
+            imax[k] = j
+            # Now j is the index of the first `u` element >= of
+            # the next bin left edge
+        counts += imax - imin
+    return counts
+
+
 @numba.jit(numba.float64[:](numba.int64[:], numba.int64[:], numba.int64[:]), nopython=True)
 def pcorrelate(t, u, bins):
     """Compute correlation of two arrays of discrete events (Point-process).
@@ -80,46 +137,346 @@ def pcorrelate(t, u, bins):
     See also:
         :func:`make_loglags` to genetate log-spaced lag bins.
     """
-    nbins = len(bins) - 1
+    counts = _pcorrelate_counts(t, u, bins)
+    G = counts / (bins[1:]-bins[:-1])
+    G = pnormalize(G, t, u, bins)
+    return G
 
-    # Array of counts (histogram)
-    counts = np.zeros(nbins, dtype=np.int64)
 
-    # For each bins, imin is the index of first `u` >= of each left bin edge
-    imin = np.zeros(nbins, dtype=np.int64)
-    # For each bins, imax is the index of first `u` >= of each right bin edge
-    imax = np.zeros(nbins, dtype=np.int64)
+def _segments(t, u, bins, threads):
+    """
+    Internal function splitting t into one segment per thread. The segments
+    are the iterations of a prange loop, so at most that many of numba's
+    threads work on them (numba's global thread count is left alone).
+    Returns the bounds of the segments of t and the bounds of the parts
+    of u within reach of their lag bins.
+    """
+    if threads is None:
+        threads = numba.config.NUMBA_NUM_THREADS
+    threads = max(min(threads, numba.config.NUMBA_NUM_THREADS, t.size), 1)
+    # segments with the same number of events take about the same time
+    t_bounds = np.linspace(0, t.size, threads + 1).astype(np.int64)
+    first = t[t_bounds[:-1]]
+    last = t[t_bounds[1:] - 1]
+    u_bounds = np.stack((np.searchsorted(u, first + bins[0]),
+                         np.searchsorted(u, last + bins[-1])), axis=1).astype(np.int64)
+    return t_bounds, u_bounds
 
-    # For each ti, perform binning of (u - ti) and accumulate counts in Y
-    for ti in t:
-        for k, (tau_min, tau_max) in enumerate(zip(bins[:-1], bins[1:])):
-            #print ('\nbin %d' % k)
 
-            if k == 0:
-                j = imin[k]
-                # We start by finding the index of the first `u` element
-                # which is >= of the first bin edge `tau_min`
-                while j < len(u):
-                    if u[j] - ti >= tau_min:
-                        break
-                    j += 1
+@numba.jit(nopython=True, parallel=True)
+def _pcorrelate_segments(t, u, bins, t_bounds, u_bounds):
+    """
+    Internal function summing _pcorrelate_counts of the segments
+    t[t_bounds[i]:t_bounds[i+1]] and u[u_bounds[i, 0]:u_bounds[i, 1]] in parallel.
+    """
+    segments = t_bounds.size - 1
+    counts = np.zeros((segments, bins.size - 1), dtype=np.int64)
+    for i in numba.prange(segments):
+        counts[i] = _pcorrelate_counts(t[t_bounds[i]:t_bounds[i+1]], u[u_bounds[i, 0]:u_bounds[i, 1]], bins)
+    return counts.sum(axis=0)
 
+
+def pcorrelate_parallel(t, u, bins, threads=None):
+    """Compute correlation of two arrays of discrete events on several cores.
+
+    Same as :func:`pcorrelate`, but `t` is split into one segment per thread,
+    each correlated with the part of `u` within reach of its lag bins
+    (i.e. the parts of `u` overlap by the largest lag). The pair counts of
+    the segments are merged before normalizing, so the result is identical.
+
+    Arguments:
+        t (array): first array of "points" to correlate. The array needs
+            to be monothonically increasing.
+        u (array): second array of "points" to correlate. The array needs
+            to be monothonically increasing.
+        bins (array): bin edges for lags where correlation is computed.
+        threads (int): number of threads, by default as many as numba uses
+            (all cores, unless NUMBA_NUM_THREADS is set).
+
+    Returns:
+        Array containing the correlation of `t` and `u`.
+        The size is `len(bins) - 1`.
+    """
+    t_bounds, u_bounds = _segments(t, u, bins, threads)
+    counts = _pcorrelate_segments(t, u, bins, t_bounds, u_bounds)
+    G = counts / (bins[1:]-bins[:-1])
+    G = pnormalize(G, t, u, bins)
+    return G
+
+
+@numba.jit(nopython=True, nogil=True)
+def _pcorrelate_weighted_counts(t, wt, u, cum_wu, bins):
+    """
+    Internal function like _pcorrelate_counts for weighted events,
+    cum_wu[j] is the total weight of u[:j].
+    """
+    nbins = len(bins) - 1
+    counts = np.zeros(nbins, dtype=np.int64)
+    imin = np.zeros(nbins, dtype=np.int64)
+    imax = np.zeros(nbins, dtype=np.int64)
+    for ti, w in zip(t, wt):
+        j = imin[0]
+        while j < len(u):
+            if u[j] - ti >= bins[0]:
+                break
+            j += 1
+        for k in range(nbins):
             imin[k] = j
             if imax[k] > j:
                 j = imax[k]
             while j < len(u):
-                if u[j] - ti >= tau_max:
+                if u[j] - ti >= bins[k+1]:
                     break
                 j += 1
             imax[k] = j
-            # Now j is the index of the first `u` element >= of
-            # the next bin left edge
-        counts += imax - imin
+            counts[k] += w * (cum_wu[imax[k]] - cum_wu[imin[k]])
+    return counts
+
+
+@numba.jit(nopython=True, parallel=True)
+def _pcorrelate_weighted_segments(t, wt, u, cum_wu, bins, t_bounds, u_bounds):
+    """
+    Internal function like _pcorrelate_segments for weighted events.
+    """
+    segments = t_bounds.size - 1
+    counts = np.zeros((segments, bins.size - 1), dtype=np.int64)
+    for i in numba.prange(segments):
+        ta, tb = t_bounds[i], t_bounds[i+1]
+        ua, ub = u_bounds[i, 0], u_bounds[i, 1]
+        counts[i] = _pcorrelate_weighted_counts(t[ta:tb], wt[ta:tb], u[ua:ub], cum_wu[ua:ub+1] - cum_wu[ua], bins)
+    return counts.sum(axis=0)
+
+
+@numba.jit(nopython=True)
+def pnormalize_weighted(G, t, wt, u, wu, bins):
+    """Normalize weighted point-process cross-correlation function.
+
+    Same as :func:`pnormalize` for events `t` and `u` (monothonically
+    increasing, without duplicates) occuring `wt` and `wu` times.
+    """
+    cum_wt = np.zeros(t.size + 1, dtype=np.int64)
+    cum_wt[1:] = np.cumsum(wt)
+    cum_wu = np.zeros(u.size + 1, dtype=np.int64)
+    cum_wu[1:] = np.cumsum(wu)
+    t_max, u_max = t[-1], u[-1]
+    duration = max((t_max, u_max)) - min((t[0], u[0]))
+    Gn = G.copy()
+    for i, tau in enumerate(bins[1:]):
+        Gn[i] *= ((duration - tau) /
+                  (float(cum_wt[-1] - cum_wt[np.searchsorted(t, tau, side='left')]) *
+                   float(cum_wu[np.searchsorted(u, u_max - tau, side='right')])))
+    return Gn
+
+
+def pcorrelate_weighted(t, wt, u, wu, bins, threads=None):
+    """Compute correlation of two arrays of weighted discrete events.
+
+    Same as :func:`pcorrelate_parallel` for events `t` and `u` occuring
+    `wt` and `wu` times, e.g. the timestamps of photons de-duplicated by
+    :func:`deduplicate`. Work scales with the number of distinct times,
+    not with the number of events.
+
+    Arguments:
+        t (array): first array of "points" to correlate. The array needs
+            to be monothonically increasing without duplicates.
+        wt (array): number of events at each of `t`.
+        u (array): second array of "points" to correlate. The array needs
+            to be monothonically increasing without duplicates.
+        wu (array): number of events at each of `u`.
+        bins (array): bin edges for lags where correlation is computed.
+        threads (int): number of threads, see :func:`pcorrelate_parallel`.
+
+    Returns:
+        Array containing the correlation of `t` and `u`.
+        The size is `len(bins) - 1`.
+    """
+    cum_wu = np.zeros(u.size + 1, dtype=np.int64)
+    np.cumsum(wu, out=cum_wu[1:])
+    t_bounds, u_bounds = _segments(t, u, bins, threads)
+    counts = _pcorrelate_weighted_segments(t, wt, u, cum_wu, bins, t_bounds, u_bounds)
     G = counts / (bins[1:]-bins[:-1])
+    G = pnormalize_weighted(G, t, wt, u, wu, bins)
+    return G
+
+
+def deduplicate(times):
+    """
+    Unique times and their multiplicities of sorted times,
+    like np.unique(times, return_counts=True) but without sorting again.
+    """
+    if times.size == 0:
+        return times[:0], np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.diff(times, prepend=times[0] - 1))
+    return times[starts], np.diff(starts, append=times.size).astype(np.int64)
+
+
+def fcorrelate(t, u, bins, resolution=1, fft_size=None):
+    """Compute correlation of two arrays of discrete events using FFT.
+
+    Same as :func:`pcorrelate`, but the events are binned with the given
+    resolution and the correlation is computed by real FFTs of blocks of
+    the binned events (overlapping by the largest lag), so memory is
+    bounded by fft_size and not the duration of the measurement.
+    Work scales with the duration / resolution, not with the number of events,
+    which makes this faster for dense events (e.g. long, bright measurements).
+
+    Arguments:
+        t (array): first array of "points" to correlate. The array needs
+            to be monothonically increasing.
+        u (array): second array of "points" to correlate. The array needs
+            to be monothonically increasing.
+        bins (array): bin edges for lags where correlation is computed.
+        resolution (int): events are binned by this (in units of `t`).
+            With 1 the result is the same as `pcorrelate` for integer times,
+            otherwise lags are only resolved to `resolution`.
+        fft_size (int): size of the FFTs, by default a power of 2 of at least
+            4 times the largest lag.
+
+    Returns:
+        Array containing the correlation of `t` and `u`.
+        The size is `len(bins) - 1`.
+    """
+    t0 = min(t[0], u[0])
+    tb = (t - t0) // resolution
+    ub = (u - t0) // resolution
+    lags = bins // resolution
+    max_lag = lags[-1]
+    if fft_size is None:
+        fft_size = 1 << int(np.ceil(np.log2(max(4 * max_lag, 2**16))))
+    block = fft_size - max_lag
+
+    # correlation for every lag up to max_lag (exclusive)
+    C = np.zeros(max_lag)
+    end = max(tb[-1], ub[-1]) + 1
+    for start in range(0, end, block):
+        ia = np.searchsorted(tb, (start, start + block))
+        iu = np.searchsorted(ub, (start, start + block + max_lag))
+        if ia[0] == ia[1] or iu[0] == iu[1]:
+            continue
+        a = np.bincount(tb[ia[0]:ia[1]] - start, minlength=block)
+        b = np.bincount(ub[iu[0]:iu[1]] - start, minlength=block + max_lag)
+        fa = np.fft.rfft(a, fft_size)
+        fb = np.fft.rfft(b, fft_size)
+        C += np.fft.irfft(np.conj(fa) * fb, fft_size)[:max_lag]
+
+    # counts are integers, remove the rounding errors of the FFT
+    Ccum = np.zeros(max_lag + 1)
+    np.cumsum(np.rint(C), out=Ccum[1:])
+    G = (Ccum[lags[1:]] - Ccum[lags[:-1]]) / (bins[1:] - bins[:-1])
     G = pnormalize(G, t, u, bins)
     return G
 
 
+class MultiTauCorrelator():
+    """
+    Online multi-tau correlator for uniformly binned counts, working like a
+    hardware correlator: it is fed consecutive blocks of counts and keeps
+    running accumulators, so the cost only depends on the new samples
+    (O(new samples * m)) and the result covers everything fed so far.
+
+    Level 0 computes lags 1..m samples, every following level works on counts
+    binned twice as coarse and adds the lags m/2+1..m (in its own units).
+
+    The normalization is the symmetric one of hardware correlators:
+    G(tau) = M * sum(a(t) * b(t+tau)) / (sum(a(t)) * sum(b(t+tau))),
+    summing over the M pairs seen for tau, i.e. G is 1 for uncorrelated data
+    (like :func:`pcorrelate`).
+
+    Parameters
+    ----------
+    pairs : list of (int, int)
+        Channels (a, b) to correlate, e.g. [(0, 1), (0, 0), (1, 1)]
+        for the cross correlation and both auto correlations.
+    max_lag : int
+        Longest lag (in samples) that should be computed.
+    m : int, optional
+        Lags per level, must be even. The default is 16.
+
+    """
+
+    def __init__(self, pairs, max_lag, m=16):
+        self.pairs = list(pairs)
+        self.channels = max(max(p) for p in self.pairs) + 1
+        self.m = m
+        self.levels = max(int(np.ceil(np.log2(max_lag / m))) + 1, 1)
+        # lags of each level in units of that level
+        self.level_lags = [np.arange(1, m + 1)] + [np.arange(m // 2 + 1, m + 1)] * (self.levels - 1)
+        self.lags = np.concatenate([k * 2**l for l, k in enumerate(self.level_lags)])
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything fed so far.
+        """
+        with self.lock:
+            shape = (len(self.pairs), self.lags.size)
+            self.products = np.zeros(shape)
+            self.sum_a = np.zeros(shape)
+            self.sum_b = np.zeros(shape)
+            self.n = np.zeros(self.lags.size)
+            self._clear_history()
+
+    def gap(self):
+        """
+        Call if samples are missing between the last and the next block,
+        so no products across the gap are accumulated.
+        """
+        with self.lock:
+            self._clear_history()
+
+    def _clear_history(self):
+        # last m values of each level, and an unpaired value for the next level
+        self.history = [np.zeros((self.channels, 0)) for _ in range(self.levels)]
+        self.leftover = [np.zeros((self.channels, 0)) for _ in range(self.levels)]
+
+    def feed(self, counts):
+        """
+        Adds a block of counts with shape (samples, channels)
+        following the previously fed block.
+        """
+        x = np.array(counts[:, :self.channels].T, dtype=np.float64)
+        with self.lock:
+            lag_idx = 0
+            for level, lags in enumerate(self.level_lags):
+                if x.shape[1] == 0:
+                    break
+                ext = np.concatenate((self.history[level], x), axis=1)
+                first_new = self.history[level].shape[1]
+                cumsum = np.zeros((self.channels, ext.shape[1] + 1))
+                np.cumsum(ext, axis=1, out=cumsum[:, 1:])
+
+                for i, k in enumerate(lags, start=lag_idx):
+                    # new samples t (with t - k in ext) pair with t - k
+                    start = max(first_new, k)
+                    end = ext.shape[1]
+                    if start >= end:
+                        continue
+                    for p, (a, b) in enumerate(self.pairs):
+                        self.products[p, i] += ext[a, start-k:end-k] @ ext[b, start:end]
+                        self.sum_a[p, i] += cumsum[a, end-k] - cumsum[a, start-k]
+                        self.sum_b[p, i] += cumsum[b, end] - cumsum[b, start]
+                    self.n[i] += end - start
+                lag_idx += lags.size
+
+                self.history[level] = ext[:, -self.m:]
+                # bin twice as coarse for the next level
+                y = np.concatenate((self.leftover[level], x), axis=1)
+                paired = y.shape[1] - y.shape[1] % 2
+                self.leftover[level] = y[:, paired:]
+                x = y[:, 0:paired:2] + y[:, 1:paired:2]
+
+    def normalized(self):
+        """
+        Returns the lags (in samples) and the normalized correlation of every
+        pair, shape (pairs, lags). Lags without data yet are NaN.
+        """
+        with self.lock:
+            denominator = self.sum_a * self.sum_b
+            with np.errstate(divide='ignore', invalid='ignore'):
+                G = np.where(denominator > 0, self.n * self.products / denominator, np.nan)
+        return self.lags, G
+
 
 def load_hdf5(filename):
     """
@@ -148,15 +505,56 @@ def load_hdf5(filename):
     return time, det, clk
 
 
+def iter_hdf5(filename, chunk_size=int(1e7)):
+    """
+    Read a photon hdf5 file in chunks, so memory use is bounded by chunk_size.
+
+    Parameters
+    ----------
+    filename : str
+        Name of file to open.
+    chunk_size : int, optional
+        Number of photons read at once. The default is 1e7.
+
+    Yields
+    ------
+    time : np.ndarray
+        Arrival times of the photons of a chunk.
+    det : np.ndarray
+        Detectors of the photons of a chunk.
+
+    """
+    with tb.open_file(filename, 'r') as f:
+        timestamps = f.root.photon_data.timestamps
+        detectors = f.root.photon_data.detectors
+        for start in range(0, timestamps.nrows, chunk_size):
+            yield timestamps.read(start, start + chunk_size), detectors.read(start, start + chunk_size)
+
+
+def load_hdf5_clk(filename):
+    """
+    Read the clock rate in seconds of a photon hdf5 file (see load_hdf5).
+    """
+    with tb.open_file(filename, 'r') as f:
+        return f.root.photon_data.timestamps_specs.timestamps_unit.read()
+
+
 @numba.jit(nopython=True)
-def proc_csv(data, expand):
+def proc_csv(data, expand, expand_by=0):
+    """
+    Convert rows (time, green, red) of a csv file into a photon-list.
+    If expand, times are multiplied by expand_by (by default the maximum
+    number of photons of a row) to make them unique. data is not modified,
+    so it can be processed in chunks of a (read-only) memory-mapped table.
+    """
     photons = data[:, 1:].sum()
     times, dets = np.empty((photons, ), dtype=np.int64), np.empty((photons, ), dtype=np.int64)
     i = 0
     if expand:
-        expand_by = data[:, 1:].max()
-        data[:,0] = expand_by*data[:,0]
+        if expand_by == 0:
+            expand_by = data[:, 1:].max()
         for t, b, g in data:
+            t = expand_by*t
             for j in range(b):
                 times[i] = t + j
                 dets[i] = 0
@@ -179,9 +577,11 @@ def proc_csv(data, expand):
     return times, dets, expand_by
 
 
-def load_csv(filename, expand=False):
+def load_csv(filename, expand=False, chunk_size=int(1e7)):
     """
     Load a csv file and convert to photon-list.
+    The parsed file is cached next to it (see read_csv.load_csv_table),
+    so loading it again is fast.
 
     Parameters
     ----------
@@ -190,6 +590,8 @@ def load_csv(filename, expand=False):
     expand : bool, optional
         Whether or not to make all arrival times unique by "expanding" arrival
         time by maximum number of photons seen at a given time. The default is False.
+    chunk_size : int, optional
+        Number of rows converted at once. The default is 1e7.
 
     Returns
     -------
@@ -201,9 +603,52 @@ def load_csv(filename, expand=False):
         Factor by which times have been multiplied.
 
     """
-    data = np.genfromtxt(filename, skip_header=1, delimiter=',', dtype=np.int64)
-    times, dets, expand_by = proc_csv(data, expand)
-    return times, dets, expand_by
+    data = load_csv_table(filename)
+    expand_by = 1
+    if expand:
+        for start in range(0, data.shape[0], chunk_size):
+            expand_by = max(expand_by, data[start:start+chunk_size, 1:].max())
+    times, dets = list(), list()
+    for start in range(0, data.shape[0], chunk_size):
+        chunk_times, chunk_dets, _ = proc_csv(np.asarray(data[start:start+chunk_size]), expand, expand_by)
+        times.append(chunk_times)
+        dets.append(chunk_dets)
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), expand_by
+    return np.concatenate(times), np.concatenate(dets), expand_by
+
+
+def proc_raw(counts, chunk_size=int(1e7)):
+    """
+    Convert counts from a raw file into a photon-list.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Counts of shape (samples, channels) as returned by load_raw.
+        Can be memory-mapped, it is processed in chunks of chunk_size samples.
+    chunk_size : int, optional
+        Number of samples processed at once. The default is 1e7.
+
+    Returns
+    -------
+    times : np.ndarray[np.int64]
+        Arrival times of photons (index of the sample).
+    dets : np.ndarray[np.uint8]
+        Detector indexes (channel) of each photon.
+
+    """
+    channels = counts.shape[1]
+    times, dets = list(), list()
+    for start in range(0, counts.shape[0], chunk_size):
+        chunk = np.asarray(counts[start:start+chunk_size]).reshape(-1)
+        nonzero = np.flatnonzero(chunk)
+        n = chunk[nonzero]
+        times.append(np.repeat(nonzero // channels + start, n).astype(np.int64))
+        dets.append(np.repeat((nonzero % channels).astype(np.uint8), n))
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(times), np.concatenate(dets)
 
 
 def _get_mask(dets, det):
@@ -235,22 +680,33 @@ def _get_mask(dets, det):
     return mask
 
 
-def proc_buffer(buf, transfer_idx, offset, stride):
-    buf_arr = np.array(buf[offset:transfer_idx:stride], dtype=np.int64)
-    return _proc_buffer(buf_arr)
+def _make_bins(clk, exp_min, exp_max, bins_per_decade, logspace):
+    """
+    Internal function generating the lag bins of correlate (in seconds)
+    and the same bins in units of clk. See correlate for the arguments.
+    """
+    # process options for generating bins
+    if logspace is None:
+        l_min = np.log(exp_min)/np.log(10)
+        l_max = np.log(exp_max)/np.log(10)
+        bins = np.logspace(l_min, l_max, int(bins_per_decade*int(l_max-l_min)))
+    elif not isinstance(logspace, np.ndarray):
+        if isinstance(logspace, dict):
+            bins = np.logspace(**logspace)
+        else:
+            bins = np.logspace(*logspace)
+    else:
+        bins = logspace
+    # rescale bins and convert to integer 
+    scale_bins = np.round(bins/clk).astype(np.int64)
+    scale_bins, index = np.unique(scale_bins, return_index=True)
+    bins = bins[index]
+    return bins, scale_bins
 
-@numba.jit(numba.int64[:](numba.int64[:]))
-def _proc_buffer(buf):
-    times = np.empty(buf.sum(), dtype=np.int64)
-    i = 0
-    for t, n in enumerate(buf):
-        for _ in range(n):
-            times[i] = t
-            i += 1
-    return times
 
 def correlate(time, clk, det=None, sort='auto', deta=None, detb=None, 
-              exp_min=1e-5, exp_max=1, bins_per_decade=5, logspace=None):
+              exp_min=1e-5, exp_max=1, bins_per_decade=5, logspace=None,
+              method='auto', resolution=1, threads=None):
     """
     Adaptable correlator function. Finds auto or cross correalation of times,
     and optional det
@@ -286,31 +742,28 @@ def correlate(time, clk, det=None, sort='auto', deta=None, detb=None,
         Overrides exp_min, exp_max and bins_per_decade, if tupel or dict used as
         *args or **kwargs respectively in np.logspace, if np.ndarray, used directly
         as bins for correlate. The default is None.
+    method : 'auto', 'pcorrelate', 'fft', optional
+        Algorithm used, see pcorrelate and fcorrelate. 'auto' uses fft if
+        there are many photons per time bin of the given resolution.
+        The default is 'auto'.
+    resolution : int, optional
+        Resolution (in units of clk) at which the fft method bins the photons.
+        The default is 1, which gives the same result as pcorrelate.
+    threads : int, optional
+        Number of threads used by the pcorrelate method (see pcorrelate_parallel).
+        The default is None, i.e. all cores.
+        With many photons at the same time, the pcorrelate method uses
+        pcorrelate_weighted on the distinct times instead.
 
     Returns
     -------
     bins: np.ndarray[np.float64]
         The bins of the output.
     corr: np.ndarray[np.float64]
-        Correlation of inputed data
+        Correlation of inputed data, NaN if there are no photons to correlate.
 
     """
-    # process options for generating bins
-    if logspace is None:
-        l_min = np.log(exp_min)/np.log(10)
-        l_max = np.log(exp_max)/np.log(10)
-        bins = np.logspace(l_min, l_max, int(bins_per_decade*int(l_max-l_min)))
-    elif not isinstance(logspace, np.ndarray):
-        if isinstance(logspace, dict):
-            bins = np.logspace(**logspace)
-        else:
-            bins = np.logspace(*logspace)
-    else:
-        bins = logspace
-    # rescale bins and convert to integer 
-    scale_bins = np.round(bins/clk).astype(np.int64)
-    scale_bins, index = np.unique(scale_bins, return_index=True)
-    bins = bins[index]
+    bins, scale_bins = _make_bins(clk, exp_min, exp_max, bins_per_decade, logspace)
     if sort == 'auto':
         if deta is None:
             timea = time
@@ -323,7 +776,258 @@ def correlate(time, clk, det=None, sort='auto', deta=None, detb=None,
             deta, detb = np.unique(det)
         timea = time[_get_mask(det, deta)]
         timeb = time[_get_mask(det, detb)]
-    return bins, pcorrelate(timea, timeb, scale_bins)
+    if timea.size == 0 or timeb.size == 0:
+        # e.g. a detector without photons, nothing to normalize by
+        return bins, np.full(scale_bins.size - 1, np.nan)
+    if method == 'auto':
+        # pcorrelate scales with photons * bins, fcorrelate with the duration,
+        # roughly equally fast at 20 photon-bins per time bin
+        duration = (max(timea[-1], timeb[-1]) - min(timea[0], timeb[0])) / resolution
+        method = 'fft' if timea.size * (scale_bins.size - 1) > 20 * duration else 'pcorrelate'
+    if method == 'fft':
+        return bins, fcorrelate(timea, timeb, scale_bins, resolution)
+    # photons quantized to the same time are correlated once, weighted,
+    # which pays off with enough duplicates
+    ta, wa = deduplicate(timea)
+    tb, wb = (ta, wa) if timeb is timea else deduplicate(timeb)
+    if timea.size + timeb.size > 1.25 * (ta.size + tb.size):
+        return bins, pcorrelate_weighted(ta, wa, tb, wb, scale_bins, threads)
+    return bins, pcorrelate_parallel(timea, timeb, scale_bins, threads)
+
+
+def correlate_hdf5(filename, sort='auto', deta=None, detb=None,
+                   exp_min=1e-5, exp_max=1, bins_per_decade=5, logspace=None,
+                   chunk_size=int(1e7), threads=None):
+    """
+    Correlator for photon hdf5 files that don't fit in memory.
+    Gives the same result as correlate on the data of load_hdf5, but reads
+    the file in chunks and only keeps photons within the largest lag of the
+    photons still to be correlated.
+
+    Parameters
+    ----------
+    filename : str
+        Name of file to open.
+    sort, deta, detb, exp_min, exp_max, bins_per_decade, logspace :
+        See correlate.
+    chunk_size : int, optional
+        Number of photons read at once. The default is 1e7.
+    threads : int, optional
+        Number of threads, see pcorrelate_parallel. The default is None.
+
+    Returns
+    -------
+    bins: np.ndarray[np.float64]
+        The bins of the output.
+    corr: np.ndarray[np.float64]
+        Correlation of inputed data, NaN if there are no photons to correlate.
+
+    """
+    clk = load_hdf5_clk(filename)
+    bins, scale_bins = _make_bins(clk, exp_min, exp_max, bins_per_decade, logspace)
+    if sort == 'auto':
+        mask_a = (lambda det: slice(None)) if deta is None else (lambda det: _get_mask(det, deta))
+        mask_b = mask_a
+    else:
+        if deta is None and detb is None:
+            dets = set()
+            for _, det in iter_hdf5(filename, chunk_size):
+                dets.update(np.unique(det))
+            deta, detb = sorted(dets)
+        mask_a = lambda det: _get_mask(det, deta)
+        mask_b = lambda det: _get_mask(det, detb)
+
+    taus = scale_bins[1:]
+    max_lag = scale_bins[-1]
+    counts = np.zeros(taus.size, dtype=np.int64)
+    # t (of deta) waiting for all u (of detb) within max_lag to be read
+    pending = np.zeros(0, dtype=np.int64)
+    window = np.zeros(0, dtype=np.int64)
+    # the last max_lag of u for the normalization
+    tail = np.zeros(0, dtype=np.int64)
+    t_below = np.zeros(taus.size, dtype=np.int64)
+    t_total, u_total = 0, 0
+    t_first, t_last, u_first = None, None, None
+
+    def correlate_pending(t):
+        nonlocal counts
+        if t.size > 0 and window.size > 0:
+            t_bounds, u_bounds = _segments(t, window, scale_bins, threads)
+            counts += _pcorrelate_segments(t, window, scale_bins, t_bounds, u_bounds)
+
+    for time, det in iter_hdf5(filename, chunk_size):
+        time = time.astype(np.int64)
+        t = time[mask_a(det)]
+        u = time[mask_b(det)]
+        last = time[-1]
+        if t.size > 0:
+            t_first = t[0] if t_first is None else t_first
+            t_last = t[-1]
+        if u.size > 0:
+            u_first = u[0] if u_first is None else u_first
+
+        t_total += t.size
+        u_total += u.size
+        t_below += np.searchsorted(t, taus, side='left')
+
+        pending = np.concatenate((pending, t))
+        window = np.concatenate((window, u))
+        if u.size > 0:
+            tail = np.concatenate((tail, u))
+            tail = tail[tail >= tail[-1] - max_lag]
+
+        # every u before the last timestamp has been read
+        ready = np.searchsorted(pending, last - max_lag, side='right')
+        correlate_pending(pending[:ready])
+        pending = pending[ready:]
+        keep_from = pending[0] if pending.size > 0 else last
+        window = window[np.searchsorted(window, keep_from + scale_bins[0]):]
+    correlate_pending(pending)
+    if t_total == 0 or u_total == 0:
+        # like correlate, e.g. for a detector without photons
+        return bins, np.full(taus.size, np.nan)
+
+    # normalize like pnormalize
+    u_max = tail[-1]
+    u_below = u_total - (tail.size - np.searchsorted(tail, u_max - taus, side='right'))
+    duration = max(t_last, u_max) - min(t_first, u_first)
+    G = counts / (scale_bins[1:] - scale_bins[:-1])
+    G *= (duration - taus) / ((t_total - t_below).astype(np.float64) * u_below.astype(np.float64))
+    return bins, G
+
+
+def counts_from_table(data):
+    """
+    Convert a count table as read from a csv file (columns time, count_0, ...)
+    into counts of shape (samples, channels) indexed by time.
+    Samples missing in the table (e.g. lost to overruns) have no counts.
+    """
+    counts = np.zeros((data[-1, 0] + 1, data.shape[1] - 1), dtype=np.int64)
+    counts[data[:, 0]] = data[:, 1:]
+    return counts
+
+
+def _select_counts(counts, det):
+    """
+    Internal function returning the counts of det, summed if det selects
+    several channels, or of all channels if det is None.
+    Counterpart of _get_mask for counts of shape (samples, channels).
+    """
+    if det is None:
+        return counts.sum(axis=1, dtype=np.int64)
+    if np.issubdtype(type(det), np.integer):
+        return counts[:, det].astype(np.int64)
+    return counts[:, list(det)].sum(axis=1, dtype=np.int64)
+
+
+@numba.jit(nopython=True, nogil=True)
+def _correlate_counts(a, bcum, bins, G):
+    """
+    Accumulates to G[k] the number of photon pairs with a lag in
+    [bins[k], bins[k+1]) between the counts a and the counts b, given as
+    prefix sums bcum (bcum[i] = b[:i].sum(), b starting at the same sample as a).
+    """
+    n = bcum.size - 1
+    for s in range(a.size):
+        if a[s] == 0:
+            continue
+        lo = bcum[min(s + bins[0], n)]
+        for k in range(bins.size - 1):
+            hi = bcum[min(s + bins[k+1], n)]
+            G[k] += a[s] * (hi - lo)
+            lo = hi
+
+
+def _count_below(cum, offset, limits, out):
+    """
+    Internal function adding to out the counts before each of limits,
+    cum being the cumulative counts of a chunk starting at offset.
+    """
+    idx = np.clip(limits - offset, 0, cum.size)
+    out += np.where(idx > 0, cum[idx - 1], 0)
+
+
+def correlate_counts(counts, clk, sort='auto', deta=None, detb=None,
+                     exp_min=1e-5, exp_max=1, bins_per_decade=5, logspace=None,
+                     channels=config.CHANNELS, chunk_size=int(1e7)):
+    """
+    Correlator working directly on binned counts, e.g. as recorded by the counter.
+    Gives the same result as correlate on the equivalent photon-list (every
+    count a photon with the time of its sample), but without expanding the
+    counts into photons: work and memory don't depend on the count rate.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Counts of shape (samples, channels), e.g. a memory-mapped raw file from
+        load_raw or counts_from_table of a csv file, which is processed in chunks
+        of chunk_size samples. A one dimensional array is taken as interleaved
+        counts like in the ring buffer.
+    clk : float
+        Duration of a sample in seconds.
+    sort, deta, detb, exp_min, exp_max, bins_per_decade, logspace :
+        See correlate, deta and detb select channels instead of detectors.
+    channels : int, optional
+        Number of interleaved channels, if counts is one dimensional.
+        The default is config.CHANNELS.
+    chunk_size : int, optional
+        Number of samples processed at once. The default is 1e7.
+
+    Returns
+    -------
+    bins: np.ndarray[np.float64]
+        The bins of the output.
+    corr: np.ndarray[np.float64]
+        Correlation of inputed data
+
+    """
+    if counts.ndim == 1:
+        counts = counts[:counts.size - counts.size % channels].reshape(-1, channels)
+    bins, scale_bins = _make_bins(clk, exp_min, exp_max, bins_per_decade, logspace)
+    if sort == 'auto':
+        detb = deta
+    elif deta is None and detb is None:
+        deta, detb = 0, 1
+    samples = counts.shape[0]
+
+    # the normalization needs the first, last and total photons of a and b
+    first = np.full(2, samples)
+    last = np.full(2, -1)
+    total = np.zeros(2, dtype=np.int64)
+    for start in range(0, samples, chunk_size):
+        chunk = np.asarray(counts[start:start+chunk_size])
+        for i, det in enumerate((deta, detb)):
+            c = _select_counts(chunk, det)
+            nonzero = np.flatnonzero(c)
+            if nonzero.size > 0:
+                first[i] = min(first[i], start + nonzero[0])
+                last[i] = max(last[i], start + nonzero[-1])
+                total[i] += c.sum()
+
+    G = np.zeros(scale_bins.size - 1, dtype=np.int64)
+    taus = scale_bins[1:]
+    # photons of a before tau and photons of b up to last[1] - tau
+    a_below = np.zeros(taus.size, dtype=np.int64)
+    b_below = np.zeros(taus.size, dtype=np.int64)
+    max_lag = scale_bins[-1]
+    for start in range(0, samples, chunk_size):
+        end = min(start + chunk_size, samples)
+        a = _select_counts(np.asarray(counts[start:end]), deta)
+        # b reaches max_lag into the next chunk
+        b = _select_counts(np.asarray(counts[start:end+max_lag]), detb)
+        bcum = np.zeros(b.size + 1, dtype=np.int64)
+        np.cumsum(b, out=bcum[1:])
+        _correlate_counts(a, bcum, scale_bins, G)
+
+        _count_below(np.cumsum(a), start, taus, a_below)
+        _count_below(bcum[1:end-start+1], start, last[1] - taus + 1, b_below)
+
+    # normalize like pnormalize
+    duration = last.max() - first.min()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = G / (scale_bins[1:] - scale_bins[:-1])
+        corr *= (duration - taus) / ((total[0] - a_below).astype(np.float64) * b_below)
+    return bins, corr
 
 
 if __name__ == "__main__":
@@ -332,36 +1036,84 @@ if __name__ == "__main__":
     parser.add_argument('filename', type=str, help="path to file")
     parser.add_argument('--deta', type=int, help='First index used for cross coorelation')
     parser.add_argument('--detb', type=int, help='Second index used for cross coorelation')
+    parser.add_argument('--threads', type=int, help='Number of threads (default all cores)')
+    parser.add_argument('--chunk-size', type=int,
+                        help='Read hdf5 files in chunks of this many photons (for files larger than memory)')
+    parser.add_argument('--lod-cache', action='store_true',
+                        help='Store the decimated trace next to the file and reuse it')
     args = parser.parse_args()
-    if args.filename[-3:] == 'csv':
-        times, dets, expand_by = load_csv(args.filename)
-        clk = 1 / expand_by / config.ACQUISITION_RATE
+    if args.chunk_size is not None and args.filename[-3:] in ('csv', 'raw'):
+        parser.error("--chunk-size only applies to hdf5 files")
+    sort = 'auto' if args.deta is None and args.detb is None else 'cross'
+    # intensity trace, at most 1e7 bins, decimated for plotting by a LOD pyramid
+    max_trace_bins = 10**7
+    lod_file = lod_filename(args.filename)
+    pyramid = LODPyramid.load(lod_file, source=args.filename) if args.lod_cache else None
+    stored = None
+    if args.filename[-3:] in ('csv', 'raw'):
+        # recorded counts are correlated directly without expanding them to photons
+        if args.filename[-3:] == 'csv':
+            counts = counts_from_table(load_csv_table(args.filename))
+            clk = 1 / config.ACQUISITION_RATE
+        else:
+            counts, acquisition_rate, _ = load_raw(args.filename)
+            clk = 1 / acquisition_rate
+        trace = TraceBuilder([max(counts.shape[0] // max_trace_bins, 1)], counts.shape[1])
+        for start in range(0, counts.shape[0] if pyramid is None else 0, int(1e7)):
+            trace.add_counts(counts[start:start+int(1e7)], start)
+        bins, corr = correlate_counts(counts, clk, sort=sort, deta=args.deta, detb=args.detb)
     else:
-        times, dets, clk = load_hdf5(args.filename)
-        
-    tbins = np.arange(0, times[-1],10000)
-    tvals = np.array([((times>=b)*(times<e)).sum() for b, e in zip(tbins[:-1], tbins[1:])])
-    pos_time = np.vstack([tbins[:-1], tvals]).T
-    bins, corr = correlate(times, clk, dets, 
-                           sort='auto' if args.deta is None and args.detb is None else 'cross', 
-                           deta=args.deta, detb=args.detb)
+        with tb.open_file(args.filename, 'r') as f:
+            if f.root.photon_data.timestamps.nrows == 0:
+                parser.error(f"{args.filename} contains no photons")
+        # traces stored by PhotonHDF5Writer are read instead of binning all photons
+        resolution, stored = load_stored_trace(args.filename, max_trace_bins)
+        if stored is not None and args.lod_cache:
+            pyramid = LODPyramid.load(lod_file, counts=stored, source=args.filename)
+        if args.chunk_size is not None:
+            clk = load_hdf5_clk(args.filename)
+            if stored is None:
+                with tb.open_file(args.filename, 'r') as f:
+                    duration = f.root.photon_data.timestamps[-1]
+                trace = TraceBuilder([max(duration // max_trace_bins, 1)], config.CHANNELS)
+                if pyramid is None:
+                    for times, dets in iter_hdf5(args.filename, args.chunk_size):
+                        trace.add_photons(times, dets)
+            bins, corr = correlate_hdf5(args.filename, sort=sort, deta=args.deta, detb=args.detb,
+                                        chunk_size=args.chunk_size, threads=args.threads)
+        else:
+            times, dets, clk = load_hdf5(args.filename)
+            if stored is None:
+                trace = TraceBuilder([max(times[-1] // max_trace_bins, 1)], int(dets.max()) + 1)
+                if pyramid is None:
+                    trace.add_photons(times, dets)
+            bins, corr = correlate(times, clk, dets, sort=sort, deta=args.deta, detb=args.detb,
+                                   threads=args.threads)
+    if stored is None:
+        resolution = trace.resolutions[0]
+    if pyramid is None:
+        pyramid = LODPyramid(trace.levels()[0] if stored is None else stored)
+        if args.lod_cache:
+            # stored traces are read from the file again
+            pyramid.save(lod_file, source=args.filename, include_counts=stored is None)
     pos_corr = np.vstack([bins[:-1], corr]).T
     
-    print(f"begin plotting, {pos_time[:10,:]}")
+    print(f"begin plotting, trace resolution {resolution * clk} s")
     canvas = scene.SceneCanvas(keys='interactive', size=(500,400), show=True, fullscreen=False)
     
     grid = canvas.central_widget.add_grid()
     
     line_graph = grid.add_view(row=0, col=1, row_span=10, col_span=15, camera='panzoom', border_color='grey')
-    # line_graph.camera.rect = (0,0,500, 400)
     
-    line_plot = scene.visuals.Line(pos=pos_time, parent=line_graph.scene, color='g')
+    # count rate, min/max envelope and mean
+    trace_plot = LODPlot(line_graph, pyramid, x_scale=resolution * clk, y_scale=1 / (resolution * clk))
+    trace_plot.show_all()
     
     line_xax = scene.AxisWidget(orientation='bottom', axis_label="time (s)")
     grid.add_widget(line_xax, 10, 1, 1, 15)
     line_xax.link_view(line_graph)
     
-    line_yax = scene.AxisWidget(orientation='left', axis_label="counts")
+    line_yax = scene.AxisWidget(orientation='left', axis_label="count rate (1/s)")
     grid.add_widget(line_yax, 0, 0, 10, 1)
     line_yax.link_view(line_graph)
     
@@ -371,9 +1123,9 @@ if __name__ == "__main__":
     logT.transform = scene.transforms.LogTransform(base=(10,0,0))
     corr_plot = scene.visuals.Line(pos=pos_corr, parent=logT)
     
-    corr_xax = scene.AxisWidget(orientation='bottom', axis_label='G(tau)')
+    corr_xax = scene.AxisWidget(orientation='bottom', axis_label='log10(tau) (s)')
     grid.add_widget(corr_xax, 20, 1, 1, 15)
-    corr_xax.link_view(logT)
+    corr_xax.link_view(corr_graph)
     
     corr_yax = scene.AxisWidget(orientation='left', axis_label='G(tau)')
     grid.add_widget(corr_yax, 10, 0, 10, 1)
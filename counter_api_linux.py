@@ -1,4 +1,5 @@
 # Linux setup code
+import numpy as np
 import uldaq
 
 from config import *
@@ -48,6 +49,14 @@ class CounterAPI():
         (_, transferstatus) = self.ctrdev.get_scan_status()
         return transferstatus.current_index - 1
 
+    def get_total_count_fn(self):
+        """
+        Number of values (samples * CHANNELS) transferred since the scan started.
+        """
+        (_, transferstatus) = self.ctrdev.get_scan_status()
+        return transferstatus.current_total_count
+
     def get_buf(self):
-        return self.buf
+        # zero-copy NumPy view on the ctypes scan buffer
+        return np.ctypeslib.as_array(self.buf)
 
@@ -1,4 +1,8 @@
 # Windows setup code
+import threading
+
+import numpy as np
+
 from mcculw import ul
 from mcculw.enums import CounterChannelType, ScanOptions, CounterMode, FunctionType, InterfaceType, CounterEdgeDetection, CounterDebounceTime, ErrorCode
 from mcculw.ul import ULError
@@ -40,6 +44,10 @@ class CounterAPI():
                     i) # mapped_channel (should be ignored by CounterMode)
 
     def start_scan(self):
+        self.total_count = 0
+        self.last_count = 0
+        # storage and live analysis poll the count from different threads
+        self.count_lock = threading.Lock()
         scanrate = ul.c_in_scan(
                 self.board_num,
                 START_CTR,
@@ -57,7 +65,20 @@ class CounterAPI():
         (_,_, cur_idx) = ul.get_status(self.board_num, FunctionType.CTRFUNCTION)
         return cur_idx
 
+    def get_total_count_fn(self):
+        """
+        Number of values (samples * CHANNELS) transferred since the scan started.
+        """
+        with self.count_lock:
+            (_, cur_count, _) = ul.get_status(self.board_num, FunctionType.CTRFUNCTION)
+            # cur_count is a 32 bit long that wraps around in long measurements
+            self.total_count += (cur_count - self.last_count) % 2**32
+            self.last_count = cur_count
+            return self.total_count
+
     def get_buf(self):
         buf = cast(self.memhandle, POINTER(c_ulonglong))
-        return buf
+        # zero-copy NumPy view, so the buffer can be sliced without
+        # dereferencing the pointer element by element
+        return np.ctypeslib.as_array(buf, shape=(PLAIN_BUFFER_SIZE,))
 
@@ -4,87 +4,50 @@ import numpy as np
 
 import write_hdf5
 from config import *
+from ring_buffer import StorageConsumer
 
-processing_first_half = True
-midpoint = PLAIN_BUFFER_SIZE // 2
-current_time = 0
 
-timestamps = list()
-detectors = list()
+def counts_to_photons(counts, first_time):
+    """
+    Converts a block of interleaved counter values into photons.
 
-acquisition = False
+    counts has to be a view on whole samples of the ring buffer, i.e. it
+    starts at a channel 0 value and contains CHANNELS values per sample.
+    Each count is repeated into that many photons with the time of its sample.
+    Within one sample, photons are ordered by channel (green before red).
 
+    If your analysis software does not allow multiple photons to have the same timestamp,
+    you will have to spread them over multiple timestamps here. This also means that the
+    resolution has to be changed (and changes in the hdf5 file).
 
-# TODO: is it better to convert it into photon arrival times now or later?
+    Returns the int64 timestamps and the uint8 detectors of the photons.
+    """
+    counts = counts.reshape(-1)
+    nonzero = np.flatnonzero(counts)
+    photons = counts[nonzero]
+    timestamps = np.repeat(nonzero // CHANNELS + first_time, photons).astype(np.int64, copy=False)
+    detectors = np.repeat((nonzero % CHANNELS).astype(np.uint8), photons)
+    return timestamps, detectors
 
-def toggle_acquisition():
-    global acquisition, timestamps, detectors, current_time
-    acquisition = not acquisition
-    print(f"Acquisition as HDF5", "started" if acquisition else "stopped")
-    if not acquisition:
-        # User just turned off acquisition
-        if len(timestamps) == 0:
-            print("Nothing recorded permanently yet, not saving.")
-        else:
-            print("amount of timestamps:", current_time)
-            print("amount of photons:", len(detectors) // CHANNELS)
-            np_timestamps = np.array(timestamps, dtype=np.int64)
-            np_detectors = np.array(detectors, dtype=np.uint8)
-            timestamps_unit = 1 / ACQUISITION_RATE
-            write_hdf5.write_file(np_timestamps, np_detectors, timestamps_unit, fname=f'measurement_{int(time.time())}')
 
-        # reset measurement
-        timestamps = []
-        detectors = []
-        current_time = 0
+def open_writer():
+    timestamps_unit = 1 / ACQUISITION_RATE
+    return write_hdf5.PhotonHDF5Writer(timestamps_unit, fname=f'measurement_{int(time.time())}',
+                                       channels=CHANNELS)
 
 
-def update_callback_fn(buf, valid_idx, total_seconds):
-    global current_time, processing_first_half
+def write(writer, first_sample, counts):
+    # Photons are appended to the file while the measurement is running
+    writer.append(*counts_to_photons(counts, first_sample))
 
-    if not acquisition:
-        return True
 
-    # TODO: test if enough points collected
-    #       if yes, stop acquisition
+def close_writer(writer):
+    if writer.photons == 0:
+        print("Nothing recorded permanently yet, not saving.")
+        writer.discard()
+    else:
+        print("amount of photons:", writer.photons)
+        writer.close()
 
-    def copy(idx):
-        global current_time
-        # if buf[idx] > 1:
-        #    print(f"GREEN: Acquisition too coarse, {buf[idx]} photons couldn't be distinguished")
-        # if buf[idx + 1] > 1:
-        #    print(f"RED:   Acquisition too coarse, {buf[idx+1]} photons couldn't be distinguished")
 
-        # If your analysis software does not allow multiple photons to have the same timestamp,
-        # You will have to adapt the following lines to not blindly repeat the arrival times and
-        # instead spread them over multiple timestamps. This also means that the resolution has
-        # to be changed. Like current_time += 10 (and changes in the hdf5 file)
-
-        if current_time // ACQUISITION_RATE >= total_seconds:
-            # End of acquisition has been reached
-            toggle_acquisition()
-            return False
-
-        # green
-        timestamps.extend([current_time] * buf[idx])
-        detectors.extend([0] * buf[idx])
-
-        # red
-        timestamps.extend([current_time] * buf[idx + 1])
-        detectors.extend([1] * buf[idx+1])
-
-        current_time += 1
-        return True
-
-    if processing_first_half and valid_idx > midpoint:
-        for i in range(0, midpoint, CHANNELS):
-            if not copy(i):
-                return False
-        processing_first_half = False
-    if not processing_first_half and valid_idx < midpoint:
-        for i in range(midpoint, BUFFER_SIZE, CHANNELS):
-            if not copy(i):
-                return False
-        processing_first_half = True
-
-    return True
+storage = StorageConsumer("HDF5", open_writer, write, close_writer)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Times the optimized code paths against the versions they replaced,
+on larger mock data than checks.py (which checks that they agree):
+
+  binning               ring_buffer.bin_span vs. the per-sample loop
+  burst-search          all-photon and dual-channel burst search
+  correlation-methods   FFT vs. pcorrelate in correlate.correlate
+  parallel-correlation  pcorrelate_parallel with 1, 2, 4, ... threads vs. pcorrelate
+
+Run from the main directory (config.yaml has to be found).
+"""
+
+import argparse
+import time
+
+import numba
+import numpy as np
+
+# puts the main directory on the path as well
+from checks import loop_binning, mock_counts, mock_photons
+
+
+def benchmark_binning(args):
+    from ring_buffer import bin_span
+
+    samples_per_bin = int(args.rate // args.bin_size)
+    plain_buffer_size = int(2 * args.rate) * args.channels
+    buf = np.random.poisson(0.1, plain_buffer_size).astype(np.int64)
+
+    # a span that wraps around the end of the buffer
+    span = int(args.seconds * args.rate) * args.channels
+    transfer_from = plain_buffer_size - span // 2
+    transfer_to = span - span // 2
+
+    for name, fn, repeat in [('loop', loop_binning, 1), ('bin_span', bin_span, 20)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(buf, transfer_from, transfer_to, samples_per_bin, args.channels)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{name:>8}: {elapsed*1e3:9.3f} ms per call, {span // args.channels / elapsed:.3g} samples/s")
+
+
+def benchmark_burst_search(args):
+    from burst_search import find_bursts, max_window_duration, proximity_ratio
+
+    times, dets = mock_photons(int(args.photons), args.clk)
+    print(f"{times.size} photons, {times[-1] * args.clk:.1f} s")
+    max_duration = max_window_duration(args.m, args.burst_rate, args.clk)
+
+    # compile first
+    find_bursts(times[:1000], dets[:1000], max_duration, args.m)
+    find_bursts(times[:1000], dets[:1000], max_duration, args.m, dual_channel=True)
+
+    for dual_channel in (False, True):
+        name = 'dual-channel' if dual_channel else 'all-photon'
+        start = time.perf_counter()
+        bursts = find_bursts(times, dets, max_duration, args.m, dual_channel=dual_channel)
+        print(f"{name:>12}: {time.perf_counter() - start:7.3f} s, {bursts.size} bursts, "
+              f"mean E {proximity_ratio(bursts).mean():.3f}")
+
+
+def benchmark_correlation_methods(args):
+    from correlate import correlate, proc_raw
+
+    times, dets = proc_raw(mock_counts(args.seconds, args.rate, 2, background=args.background))
+    print(f"{times.size} photons")
+
+    for method in ('pcorrelate', 'fft'):
+        for sort in ('auto', 'cross'):
+            start = time.perf_counter()
+            correlate(times, 1 / args.rate, dets, sort=sort, method=method)
+            print(f"{method:>10} {sort:>5}: {time.perf_counter() - start:7.3f} s")
+
+
+def benchmark_parallel_correlation(args):
+    from correlate import _make_bins, pcorrelate, pcorrelate_parallel
+
+    rng = np.random.default_rng(0)
+    samples = int(args.seconds * args.rate)
+    t = np.repeat(np.arange(samples), rng.poisson(args.counts, samples))
+    u = np.repeat(np.arange(samples), rng.poisson(args.counts, samples))
+    _, bins = _make_bins(1 / args.rate, 1e-5, 1, 5, None)
+    print(f"{t.size + u.size} photons, {bins.size - 1} lag bins")
+
+    # compile first
+    pcorrelate(t[:1000], u[:1000], np.arange(3))
+    pcorrelate_parallel(t[:1000], u[:1000], np.arange(3), 1)
+
+    start = time.perf_counter()
+    pcorrelate(t, u, bins)
+    serial = time.perf_counter() - start
+    print(f"  serial: {serial:7.3f} s")
+
+    # powers of 2 and all cores
+    for threads in sorted({2**i for i in range(int(np.log2(args.max_threads)) + 1)} | {args.max_threads}):
+        start = time.perf_counter()
+        pcorrelate_parallel(t, u, bins, threads)
+        elapsed = time.perf_counter() - start
+        print(f"{threads:>2} threads: {elapsed:7.3f} s, speedup {serial / elapsed:5.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark optimized code paths')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    binning = subparsers.add_parser('binning', help='live view binning')
+    binning.add_argument('--rate', type=float, default=2e6, help='acquisition rate (samples/s)')
+    binning.add_argument('--bin-size', type=float, default=1e3, help='bins per second')
+    binning.add_argument('--channels', type=int, default=2)
+    binning.add_argument('--seconds', type=float, default=0.1, help='data binned per call')
+    binning.set_defaults(fn=benchmark_binning)
+
+    bursts = subparsers.add_parser('burst-search', help='burst search')
+    bursts.add_argument('--photons', type=float, default=1e8)
+    bursts.add_argument('--clk', type=float, default=1e-8, help='timestamp unit (s)')
+    bursts.add_argument('--burst-rate', type=float, default=200e3, help='minimum burst rate (photons/s)')
+    bursts.add_argument('-m', type=int, default=10, help='photons per window')
+    bursts.set_defaults(fn=benchmark_burst_search)
+
+    methods = subparsers.add_parser('correlation-methods', help='FFT vs. pcorrelate')
+    methods.add_argument('--rate', type=float, default=2e6, help='acquisition rate (samples/s)')
+    methods.add_argument('--seconds', type=float, default=10)
+    methods.add_argument('--background', type=float, default=0.01, help='background counts per sample')
+    methods.set_defaults(fn=benchmark_correlation_methods)
+
+    parallel = subparsers.add_parser('parallel-correlation', help='pcorrelate_parallel scaling')
+    parallel.add_argument('--rate', type=float, default=2e6, help='acquisition rate (samples/s)')
+    parallel.add_argument('--seconds', type=float, default=10)
+    parallel.add_argument('--counts', type=float, default=0.2, help='counts per sample and channel')
+    parallel.add_argument('--max-threads', type=int, default=numba.config.NUMBA_NUM_THREADS)
+    parallel.set_defaults(fn=benchmark_parallel_correlation)
+
+    args = parser.parse_args()
+    if args.fn is benchmark_parallel_correlation and args.seconds <= 1:
+        parser.error("--seconds has to be longer than the largest lag (1 s)")
+    args.fn(args)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Checks the optimized code paths against the straightforward versions they
+replaced, on small mock data:
+
+  pnormalize            binary searches vs. the scan per lag bin
+  write-hdf5            PhotonHDF5Writer files (with and without photons) read back
+  correlation-methods   FFT vs. pcorrelate in correlate.correlate
+  parallel-correlation  pcorrelate_parallel vs. pcorrelate
+  binning               ring_buffer.bin_span vs. the per-sample loop
+  burst-search          burst search in chunks vs. all at once
+
+Runs all checks (or the ones given) and exits with 1 if one fails.
+benchmark.py times the same code on larger data.
+Run from the main directory (config.yaml has to be found).
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numba
+import numpy as np
+
+# the checked modules live in the main directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@numba.jit(numba.float64[:](numba.float64[:], numba.int64[:], numba.int64[:], numba.int64[:]), nopython=True)
+def loop_pnormalize(G, t, u, bins):
+    """
+    The version pnormalize used before, counting with a scan per lag bin.
+    """
+    duration = max((t.max(), u.max())) - min((t.min(), u.min()))
+    Gn = G.copy()
+    for i, tau in enumerate(bins[1:]):
+        Gn[i] *= ((duration - tau) /
+                  (float((t >= tau).sum()) *
+                   float((u <= (u.max() - tau)).sum())))
+    return Gn
+
+
+def loop_binning(buf, transfer_from, transfer_to, samples_per_bin, channels):
+    """
+    The nested loop transfer_data used before bin_span.
+    """
+    transferrable_samples = transfer_to - transfer_from
+    if transferrable_samples <= 0:
+        transferrable_samples += buf.size
+    transferrable_bins = transferrable_samples // channels // samples_per_bin
+
+    bins = np.zeros((transferrable_bins, channels))
+    buf_idx = transfer_from
+    for b in range(transferrable_bins):
+        for _ in range(samples_per_bin):
+            for c in range(channels):
+                bins[b, c] += buf[buf_idx + c]
+            buf_idx = (buf_idx + channels) % buf.size
+    return bins
+
+
+def mock_counts(seconds, rate, channels, bin_size=1000, burst_photons=50, background=0.01):
+    """
+    Bursts of photons (normal distribution, 1 ms wide) in random bins of
+    1/bin_size seconds on top of a poisson background, like MockCounter.
+    """
+    rng = np.random.default_rng(0)
+    samples = int(seconds * rate)
+    counts = rng.poisson(background, size=(samples, channels))
+    samples_per_bin = int(rate // bin_size)
+    for b in np.flatnonzero(rng.poisson(0.1, samples // samples_per_bin)):
+        center = b * samples_per_bin + rng.integers(samples_per_bin)
+        for c in range(channels):
+            locs = rng.normal(center, 1e-3 * rate, rng.poisson(burst_photons)).astype(np.int64)
+            locs = locs[(locs >= 0) & (locs < samples)]
+            np.add.at(counts[:, c], locs, 1)
+    return counts
+
+
+def mock_photons(photons, clk, background=20e3, burst_photons=100, burst_width=3e-4):
+    """
+    Bursts (normal distribution) of burst_photons each on top of a poisson
+    background (photons/s), split randomly onto donor and acceptor.
+    """
+    rng = np.random.default_rng(0)
+    bursts = photons // (2 * burst_photons)
+    duration = int((photons - bursts * burst_photons) / background / clk)
+    times = [rng.integers(0, duration, photons - bursts * burst_photons)]
+    centers = rng.integers(0, duration, bursts)
+    times.append((np.repeat(centers, burst_photons) + rng.normal(0, burst_width / clk, bursts * burst_photons)).astype(np.int64))
+    times = np.sort(np.concatenate(times))
+    return times, rng.integers(0, 2, times.size).astype(np.uint8)
+
+
+def _outcome(fn, *args):
+    """
+    Result of fn or the type of the exception it raised.
+    """
+    try:
+        return fn(*args)
+    except Exception as e:
+        return type(e)
+
+
+def check_pnormalize():
+    from correlate import _pcorrelate_counts, pnormalize
+
+    def cases():
+        rng = np.random.default_rng(0)
+        log_bins = np.unique(np.logspace(0, 6, 60).astype(np.int64))
+        for n in (1, 10, 1000, 100000):
+            t = np.sort(rng.integers(0, 10 * n, n))
+            u = np.sort(rng.integers(0, 10 * n, n))
+            yield f"random {n}", t, u, log_bins[log_bins < 5 * n]
+        # many photons per time, as proc_raw generates them
+        t = np.repeat(np.arange(1000), rng.poisson(2, 1000))
+        u = np.repeat(np.arange(1000), rng.poisson(2, 1000))
+        yield "duplicate times", t, u, np.arange(0, 500, 7)
+        yield "identical inputs", t, t, np.arange(0, 500, 7)
+        # lag bins in which no pairs are found
+        yield "sparse", np.array([0, 1000, 2000]), np.array([5, 3000]), np.array([0, 1, 2, 3, 100, 200])
+        yield "single photon", np.array([7]), np.array([7]), np.array([0, 1, 2])
+        yield "lags beyond last photon", t, u, np.array([0, 10, 2000, 5000])
+        yield "no lag bins", t, u, np.array([0])
+        yield "empty t", t[:0], u, np.array([0, 10])
+        yield "empty u", t, u[:0], np.array([0, 10])
+
+    failed = list()
+    for name, t, u, bins in cases():
+        t, u, bins = (np.ascontiguousarray(a, dtype=np.int64) for a in (t, u, bins))
+        if t.size > 0 and u.size > 0:
+            G = _pcorrelate_counts(t, u, bins).astype(np.float64)
+        else:
+            G = np.ones(max(bins.size - 1, 0))
+        expected = _outcome(loop_pnormalize, G, t, u, bins)
+        result = _outcome(pnormalize, G, t, u, bins)
+        if isinstance(expected, type) or isinstance(result, type):
+            # the same exception (e.g. ZeroDivisionError for lags beyond the last photon)
+            ok = (isinstance(expected, type) and isinstance(result, type)
+                  and issubclass(result, expected))
+        else:
+            ok = np.array_equal(result, expected, equal_nan=True)
+        if not ok:
+            failed.append(name)
+    return failed
+
+
+def check_write_hdf5():
+    import phconvert as phc
+    from write_hdf5 import PhotonHDF5Writer
+
+    cases = dict(
+        empty=(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)),
+        photons=(np.arange(0, int(1e7), 7, dtype=np.int64), np.arange(0, int(1e7), 7).astype(np.uint8) % 2),
+    )
+    failed = list()
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (timestamps, detectors) in cases.items():
+            fname = os.path.join(tmp, name)
+            writer = PhotonHDF5Writer(1e-7, fname=fname)
+            if timestamps.size > 0:
+                writer.append(timestamps, detectors)
+            writer.close()
+            h5file = phc.hdf5.load_photon_hdf5(f'{fname}.h5')
+            try:
+                duration = h5file.root.acquisition_duration.read()
+                expected = 0 if timestamps.size == 0 else np.round((timestamps[-1] - timestamps[0]) * 1e-7, 1)
+                ok = (not writer.h5file.isopen
+                      and np.array_equal(h5file.root.photon_data.timestamps.read(), timestamps)
+                      and np.array_equal(h5file.root.photon_data.detectors.read(), detectors)
+                      and duration == expected)
+            finally:
+                h5file.close()
+            if not ok:
+                failed.append(name)
+    return failed
+
+
+def check_correlation_methods(rate=2e6, seconds=3):
+    from correlate import correlate, proc_raw
+
+    times, dets = proc_raw(mock_counts(seconds, rate, 2))
+    failed = list()
+    for sort in ('auto', 'cross'):
+        _, expected = correlate(times, 1 / rate, dets, sort=sort, method='pcorrelate')
+        _, corr = correlate(times, 1 / rate, dets, sort=sort, method='fft')
+        if not np.max(np.abs(corr - expected)) <= 1e-9:
+            failed.append(sort)
+    return failed
+
+
+def check_parallel_correlation(rate=2e6, seconds=3):
+    from correlate import _make_bins, pcorrelate, pcorrelate_parallel
+
+    rng = np.random.default_rng(0)
+    samples = int(seconds * rate)
+    t = np.repeat(np.arange(samples), rng.poisson(0.2, samples))
+    u = np.repeat(np.arange(samples), rng.poisson(0.2, samples))
+    _, bins = _make_bins(1 / rate, 1e-5, 1, 5, None)
+    expected = pcorrelate(t, u, bins)
+    return [f"{threads} threads" for threads in (1, 2, 3, 8)
+            if not np.array_equal(pcorrelate_parallel(t, u, bins, threads), expected)]
+
+
+def check_binning(rate=2e5, channels=2):
+    from ring_buffer import bin_span
+
+    buf = np.random.default_rng(0).poisson(0.1, int(2 * rate) * channels).astype(np.int64)
+    samples_per_bin = int(rate // 1000)
+    span = int(0.1 * rate) * channels
+    failed = list()
+    # a span within the buffer and one that wraps around its end
+    for name, transfer_from in (("contiguous", 0), ("wrapping", buf.size - span // 2)):
+        transfer_to = (transfer_from + span) % buf.size
+        expected = loop_binning(buf, transfer_from, transfer_to, samples_per_bin, channels)
+        if not np.array_equal(bin_span(buf, transfer_from, transfer_to, samples_per_bin, channels), expected):
+            failed.append(name)
+    return failed
+
+
+def check_burst_search(clk=1e-8, rate=200e3, m=10):
+    from burst_search import find_bursts, max_window_duration
+
+    times, dets = mock_photons(int(1e6), clk)
+    max_duration = max_window_duration(m, rate, clk)
+    failed = list()
+    for dual_channel in (False, True):
+        chunked = find_bursts(times, dets, max_duration, m, dual_channel=dual_channel, chunk_size=997)
+        whole = find_bursts(times, dets, max_duration, m, dual_channel=dual_channel, chunk_size=times.size)
+        if not np.array_equal(chunked, whole):
+            failed.append('dual-channel' if dual_channel else 'all-photon')
+    return failed
+
+
+checks = {
+    'pnormalize': check_pnormalize,
+    'write-hdf5': check_write_hdf5,
+    'correlation-methods': check_correlation_methods,
+    'parallel-correlation': check_parallel_correlation,
+    'binning': check_binning,
+    'burst-search': check_burst_search,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check optimized code paths against their reference versions')
+    parser.add_argument('checks', nargs='*', help=f'checks to run (default all): {", ".join(checks)}')
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in checks]
+    if len(unknown) > 0:
+        parser.error(f"unknown checks: {', '.join(unknown)}")
+
+    failed = False
+    for name in args.checks or checks:
+        try:
+            failures = checks[name]()
+        except Exception as e:
+            failures = [repr(e)]
+        print(f"{name:>20}: {'ok' if len(failures) == 0 else 'failed (' + ', '.join(failures) + ')'}")
+        failed |= len(failures) > 0
+
+    sys.exit(1 if failed else 0)
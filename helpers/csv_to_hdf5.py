@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Converts measurement CSV files (from csv_acquisition) to Photon-HDF5,
+one file per process. Files are read and written in blocks, so memory use
+doesn't depend on the size of the files.
+Gaps in the time column (samples lost to ring buffer overruns) are recorded
+like hdf_acquisition does.
+Run from the main directory (config.yaml has to be found).
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+# correlate, read_csv and write_hdf5 live in the main directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def convert(filename, output_dir, expand, rate, block_size):
+    """
+    Converts one file, returns (output filename, photons, seconds).
+    Files without photons are skipped (output filename None).
+    """
+    from correlate import proc_csv
+    from read_csv import iter_csv
+    import write_hdf5
+
+    start = time.perf_counter()
+    expand_by = 1
+    if expand:
+        # times are expanded by the maximum photons of a sample in the whole file
+        for rows in iter_csv(filename, block_size):
+            if rows.shape[0] > 0:
+                expand_by = max(expand_by, int(rows[:, 1:].max()))
+
+    fname = os.path.join(output_dir or os.path.dirname(filename), os.path.splitext(os.path.basename(filename))[0])
+    writer = write_hdf5.PhotonHDF5Writer(1 / rate / expand_by, fname)
+    try:
+        last_time = -1
+        for rows in iter_csv(filename, block_size):
+            if rows.shape[0] == 0:
+                continue
+            # a gap in the time column means lost samples
+            times = np.concatenate(([last_time], rows[:, 0]))
+            for gap in np.flatnonzero(np.diff(times) > 1):
+                writer.add_overrun((times[gap] + 1) * expand_by, int(times[gap + 1] - times[gap] - 1))
+            last_time = rows[-1, 0]
+
+            timestamps, detectors, _ = proc_csv(rows, expand, expand_by)
+            writer.append(timestamps, detectors.astype(np.uint8))
+    except:
+        # don't leave a partial file behind
+        writer.discard()
+        raise
+
+    photons = writer.photons
+    if photons == 0:
+        # like hdf_acquisition, recordings without photons are not saved
+        writer.discard()
+        return None, 0, time.perf_counter() - start
+    writer.close()
+    return writer.filename, photons, time.perf_counter() - start
+
+
+def convert_args(args):
+    filename = args[0]
+    try:
+        return (filename, *convert(*args))
+    except Exception as e:
+        return filename, e, 0, 0
+
+
+if __name__ == '__main__':
+    from config import ACQUISITION_RATE
+
+    parser = argparse.ArgumentParser(description='Convert measurement CSV files to Photon-HDF5')
+    parser.add_argument('inputs', nargs='+', help='CSV files or directories containing measurement_*.csv files')
+    parser.add_argument('-o', '--output-dir', help='directory for the HDF5 files (default next to the CSV files)')
+    parser.add_argument('--expand', action='store_true',
+                        help='make arrival times unique by expanding them by the maximum photons per sample')
+    parser.add_argument('--rate', type=float, default=ACQUISITION_RATE, help='acquisition rate (samples/s)')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(), help='number of parallel conversions')
+    parser.add_argument('--block-size', type=int, default=64, help='MB of a CSV file parsed at once')
+    args = parser.parse_args()
+
+    filenames = list()
+    for path in args.inputs:
+        if os.path.isdir(path):
+            filenames += sorted(glob.glob(os.path.join(path, 'measurement_*.csv')))
+        else:
+            filenames.append(path)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = [(f, args.output_dir, args.expand, args.rate, args.block_size * 1024 * 1024) for f in filenames]
+    total_start = time.perf_counter()
+    with multiprocessing.Pool(min(args.processes, max(len(jobs), 1))) as pool:
+        for filename, output, photons, elapsed in pool.imap_unordered(convert_args, jobs):
+            if isinstance(output, Exception):
+                print(f"{filename}: failed ({output})")
+                continue
+            if output is None:
+                print(f"{filename}: no photons, skipped")
+                continue
+            size = os.path.getsize(filename) / 1e6
+            print(f"{filename} -> {output}: {photons} photons, "
+                  f"{size / elapsed:.1f} MB/s, {photons / elapsed:.3g} photons/s")
+    print(f"converted {len(jobs)} files in {time.perf_counter() - total_start:.1f} s")
@@ -1,36 +1,182 @@
 #!/usr/bin/env python3
 
+"""
+Histogram of the peak heights of the green trace.
+
+Peaks are local maxima (as scipy.signal.find_peaks finds them) of at least
+mean + 0.8 * stddev of the trace. The file is read once in chunks: the
+heights of all local maxima are counted in a histogram and the mean and
+variance are kept as running values, so the threshold is applied at the end.
+The trace is also written to a temporary file, plotted from a min/max
+decimation (lod.LODPyramid) of it, and the peaks are marked in a second
+pass over that file.
+Run from the main directory (config.yaml has to be found).
+"""
+
 import argparse
-import scipy.signal
+import os
+import sys
+import tempfile
 
+import numba
 import numpy as np
 
 import matplotlib.pyplot as plt
 
+# raw_file, read_csv, correlate, traces and lod live in the main directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from traces import TraceBuilder
+from lod import LODPyramid
+
+
+@numba.jit(nopython=True)
+def _count_peaks(x, state, hist):
+    """
+    Counts the local maxima of x by height into hist, continuing the values
+    before (state holds the previous value and whether the values rose to it).
+    Plateaus count once, the first and last value are no peaks.
+    """
+    prev, rising = state[0], state[1]
+    for v in x:
+        if v > prev:
+            rising = 1
+        elif v < prev:
+            if rising:
+                hist[prev] += 1
+            rising = 0
+        prev = v
+    state[0], state[1] = prev, rising
+
+
+@numba.jit(nopython=True)
+def _mark_peaks(x, first, state, threshold, width, marks):
+    """
+    Finds the same peaks as _count_peaks, x[0] being value first of the
+    trace (state additionally holds where the values rose to the previous
+    value). The height of every peak of at least threshold is entered into
+    marks[position // width], keeping the highest. Plateaus are at their middle.
+    """
+    prev, rising, rise = state[0], state[1], state[2]
+    for i in range(x.size):
+        v = x[i]
+        if v > prev:
+            rising = 1
+            rise = first + i
+        elif v < prev:
+            if rising and prev >= threshold:
+                b = (rise + first + i - 1) // 2 // width
+                marks[b] = max(marks[b], prev)
+            rising = 0
+        prev = v
+    state[0], state[1], state[2] = prev, rising, rise
+
+
+def iter_trace(filename, resolution, chunk_size=int(1e7)):
+    """
+    Yields consecutive chunks of the green and red trace (bins of resolution
+    samples or timestamp units, shape (bins, 2)) of a csv, raw or hdf5 file.
+    """
+    trace = TraceBuilder([resolution])
+    if filename.endswith('.raw'):
+        from raw_file import load_raw
+        counts, _, _ = load_raw(filename)
+        for start in range(0, counts.shape[0], chunk_size):
+            trace.add_counts(counts[start:start+chunk_size], start)
+            yield trace.pop_finished()[0][1]
+    elif filename.endswith('.csv'):
+        from read_csv import iter_csv
+        samples = 0
+        for rows in iter_csv(filename):
+            trace.add_counts(rows[:, 1:], samples)
+            samples += rows.shape[0]
+            yield trace.pop_finished()[0][1]
+    else:
+        from correlate import iter_hdf5
+        from traces import iter_stored_trace, stored_resolutions
+        if any(resolution % r == 0 for r in stored_resolutions(filename)):
+            # summed up from the trace stored in the file
+            yield from iter_stored_trace(filename, resolution, chunk_size=chunk_size)
+            return
+        for times, dets in iter_hdf5(filename, chunk_size):
+            trace.add_photons(times, dets)
+            yield trace.pop_finished()[0][1]
+    trace.finish()
+    yield trace.pop_finished()[0][1]
+
+
 parser = argparse.ArgumentParser(description='Generate burst size histogram')
-parser.add_argument('filename', help='CSV file to read (should be reduced)')
+parser.add_argument('filename', help='CSV file (should be reduced), raw or photon hdf5 file to read')
+parser.add_argument('--resolution', type=int, default=1,
+                    help='Samples (timestamp units for hdf5 files) per bin of the trace')
+parser.add_argument('--plot-bins', type=int, default=4096,
+                    help='Bins of the decimated trace that is plotted')
 
 args = parser.parse_args()
 
 print("Processing", args.filename)
 
-data = np.genfromtxt(args.filename, delimiter=',', skip_header=1)
+# running mean and variance (sum of squared deviations) of the green trace
+n, mean, m2 = 0, 0.0, 0.0
+hist = np.zeros(1, dtype=np.int64)
+state = np.array([np.iinfo(np.int64).max, 0], dtype=np.int64)
+
+with tempfile.TemporaryDirectory() as tmp:
+    # the trace for plotting, memory-mapped below
+    trace_filename = os.path.join(tmp, 'trace.bin')
+    with open(trace_filename, 'wb') as trace_file:
+        for trace in iter_trace(args.filename, args.resolution):
+            if trace.shape[0] == 0:
+                continue
+            green = trace[:, 0]
+            # combine the statistics of the chunk with the ones before (Chan et al.)
+            chunk_mean = green.mean()
+            delta = chunk_mean - mean
+            total = n + green.size
+            m2 += ((green - chunk_mean) ** 2).sum() + delta ** 2 * n * green.size / total
+            mean += delta * green.size / total
+            n = total
+
+            if green.max() >= hist.size:
+                hist = np.pad(hist, (0, green.max() + 1 - hist.size))
+            _count_peaks(green, state, hist)
+            trace_file.write(np.ascontiguousarray(trace[:, :2], dtype=np.int32).tobytes())
 
-green = data[:, 1]
-red = data[:, 2]
+    stddev = np.sqrt(m2 / max(n, 1))
+    threshold = mean + 0.8 * stddev
+    heights = np.arange(hist.size)
+    peaks = (heights >= threshold) & (hist > 0)
+    print(f"{hist[peaks].sum()} peaks of at least {threshold:.2f} (mean {mean:.2f}, stddev {stddev:.2f})")
+    if n == 0:
+        sys.exit("No data")
 
-mean = np.mean(green)
-stddev = np.std(green)
+    counts = np.memmap(trace_filename, dtype=np.int32, mode='r').reshape(-1, 2)
+    # level 1 (if needed) already has at most plot_bins bins
+    factor = max(-(-n // args.plot_bins), 2)
+    pyramid = LODPyramid(counts, factor=factor, min_bins=args.plot_bins,
+                         chunk_size=max(int(1e7) // factor, 1) * factor)
+    level = pyramid.select(0, n, args.plot_bins)
+    width = pyramid.factor ** level
+    mins, maxs, means = (np.asarray(a) for a in pyramid.level_data(level, 0, pyramid.level_bins(level)))
+    x = (np.arange(mins.shape[0]) + 0.5) * width * args.resolution
 
-peak_idxs, props = scipy.signal.find_peaks(green, height=mean+0.8*stddev)
+    # highest peak of at least the threshold per plotted bin
+    marks = np.full(mins.shape[0], -1, dtype=np.int64)
+    mark_state = np.array([np.iinfo(np.int64).max, 0, 0], dtype=np.int64)
+    chunk_size = int(1e7)
+    for start in range(0, n, chunk_size):
+        green = np.ascontiguousarray(counts[start:start+chunk_size, 0])
+        _mark_peaks(green, start, mark_state, threshold, width, marks)
+    del pyramid, counts
 
 fig, (ax1, ax2) = plt.subplots(2,1)
 
-ax1.plot(green, color='g')
-ax1.plot(red, color='r')
-ax1.plot(peak_idxs, green[peak_idxs], "x", color='m')
+ax1.fill_between(x, mins[:, 0], maxs[:, 0], color='g', step='mid')
+ax1.fill_between(x, mins[:, 1], maxs[:, 1], color='r', alpha=0.5, step='mid')
+marked = marks >= 0
+ax1.plot(x[marked], marks[marked], "x", color='m')
 
-ax2.hist(props['peak_heights'], color='g')
+ax2.hist(heights[peaks], weights=hist[peaks], color='g')
 ax2.set_xlabel("Peak height")
 ax2.set_ylabel("N")
 
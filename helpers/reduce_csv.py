@@ -1,28 +1,217 @@
 #!/usr/bin/env python3
 
+"""
+Reduces measurements to time,green,red CSV files with the counts of every
+factor consecutive samples summed up (the time column is the number of the
+sum, counting from 1), e.g. for histogram_peak_height.py. Measurements of
+one channel are reduced to time,green files.
+
+Reads CSV, raw and Photon-HDF5 files in blocks, so memory use doesn't depend
+on the size of the files, and writes one reduced file per input and factor.
+Traces stored in Photon-HDF5 files (by PhotonHDF5Writer) are summed up
+instead of binning the photons if the factor is a multiple of their resolution.
+Several files are reduced in parallel.
+Run from the main directory (config.yaml has to be found).
+"""
+
+import argparse
+import multiprocessing
+import os
 import sys
-import csv
+import time
+
+import numpy as np
+
+# read_csv, raw_file, correlate, traces and write_csv live in the main directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 RESAMPLE_FACTOR = int(2e2)
 
-with open(sys.argv[1], 'r') as f:
-    reader = csv.reader(f)
-    next(reader)  # skip header
-    with open(sys.argv[2], 'w+', newline='') as o:
-        writer = csv.writer(o)
-        writer.writerow(['time', 'green', 'red'])
-
-        samples = 0
-        green = 0
-        red = 0
-        for row in reader:
-            t, g, r = row
-            t = int(t)
-            green += int(g)
-            red += int(r)
-            samples += 1
-            if samples == RESAMPLE_FACTOR:
-                writer.writerow([(t+1)//RESAMPLE_FACTOR, green, red])
-                samples = 0
-                green = 0
-                red = 0
+HEADER = ['time', 'green', 'red']
+
+
+class Reducer():
+    """
+    Sums groups of factor consecutive rows (time and the counts of every
+    channel) fed in blocks and writes them to a CSV file.
+    Incomplete groups at the end are dropped.
+    """
+
+    def __init__(self, filename, factor, channels=2):
+        from write_csv import format_table
+
+        self.format_table = format_table
+        self.filename = filename
+        self.factor = factor
+        self.columns = channels + 1
+        self.rest = np.zeros((0, self.columns), dtype=np.int64)
+        self.file = open(filename, 'wb')
+        self.file.write(",".join(HEADER[:self.columns]).encode() + b'\r\n')
+
+    def add(self, rows):
+        if self.rest.shape[0] > 0:
+            # complete the group started by the previous block
+            head = np.concatenate((self.rest, rows[:self.factor - self.rest.shape[0]]))
+            rows = rows[self.factor - self.rest.shape[0]:]
+            if head.shape[0] < self.factor:
+                self.rest = head
+                return
+            self._add_groups(head)
+        full = rows.shape[0] - rows.shape[0] % self.factor
+        self._add_groups(rows[:full])
+        self.rest = np.array(rows[full:], dtype=np.int64)
+
+    def _add_groups(self, rows):
+        groups = rows.reshape(-1, self.factor, self.columns)
+        table = np.empty((groups.shape[0], self.columns), dtype=np.int64)
+        # time of the last sample of the group, in units of factor samples
+        table[:, 0] = (groups[:, -1, 0] + 1) // self.factor
+        table[:, 1:] = groups[:, :, 1:].sum(axis=1)
+        self.write(table)
+
+    def write(self, table):
+        self.file.write(self.format_table(table))
+
+    def close(self):
+        self.file.close()
+
+
+def _table(first_bin, bins, columns):
+    """
+    Rows (time and the counts of columns - 1 detectors) of bins,
+    the first one being bin first_bin.
+    """
+    table = np.empty((bins.shape[0], columns), dtype=np.int64)
+    table[:, 0] = np.arange(first_bin + 1, first_bin + 1 + bins.shape[0])
+    table[:, 1:] = bins[:, :columns - 1]
+    return table
+
+
+def _hdf5_detectors(filename):
+    """
+    Number of detectors (highest id + 1) of a photon hdf5 file.
+    """
+    import tables as tb
+
+    with tb.open_file(filename, 'r') as f:
+        if '/setup/detectors/id' in f:
+            ids = f.get_node('/setup/detectors/id').read()
+            if ids.size > 0:
+                return int(ids.max()) + 1
+        detectors = f.root.photon_data.detectors
+        highest = 0
+        for start in range(0, detectors.nrows, int(1e7)):
+            highest = max(highest, int(detectors.read(start, start + int(1e7)).max()))
+        return highest + 1
+
+
+def reduce_file(filename, output_dir, factors, rate, block_size, output=None):
+    """
+    Reduces one file by all factors, returns the output filenames.
+    With output, the file is reduced by the only factor to that file.
+    """
+    base = os.path.join(output_dir or os.path.dirname(filename), os.path.splitext(os.path.basename(filename))[0])
+
+    def make_reducers(channels):
+        # green and red at most
+        channels = min(channels, len(HEADER) - 1)
+        if output is not None:
+            return [Reducer(output, factors[0], channels)]
+        return [Reducer(f'{base}_reduced_{factor}.csv', factor, channels) for factor in factors]
+
+    if filename.endswith('.csv'):
+        from read_csv import iter_csv, read_header
+        reducers = make_reducers(len(read_header(filename)) - 1)
+        columns = reducers[0].columns
+        for rows in iter_csv(filename, block_size):
+            for reducer in reducers:
+                reducer.add(rows[:, :columns])
+    elif filename.endswith('.raw'):
+        from raw_file import load_raw
+        counts, _, _ = load_raw(filename)
+        reducers = make_reducers(counts.shape[1])
+        columns = reducers[0].columns
+        chunk = block_size // (8 * counts.shape[1])
+        for start in range(0, counts.shape[0], chunk):
+            block = counts[start:start+chunk]
+            rows = np.empty((block.shape[0], columns), dtype=np.int64)
+            rows[:, 0] = np.arange(start, start + block.shape[0])
+            rows[:, 1:] = block[:, :columns - 1]
+            for reducer in reducers:
+                reducer.add(rows)
+    else:
+        detectors = _hdf5_detectors(filename)
+        reducers = make_reducers(detectors)
+        columns = reducers[0].columns
+        from correlate import iter_hdf5, load_hdf5_clk
+        from traces import TraceBuilder, iter_stored_trace, stored_resolutions
+        # factors are in samples, the timestamps may be finer (expanded)
+        per_sample = 1 if rate is None else max(int(round(1 / (rate * load_hdf5_clk(filename)))), 1)
+        resolutions = [factor * per_sample for factor in factors]
+        # traces stored in the file are summed up instead of binning all photons
+        stored = stored_resolutions(filename)
+        computed = list()
+        for reducer, resolution in zip(reducers, resolutions):
+            if any(resolution % r == 0 for r in stored):
+                first_bin = 0
+                # without the last, possibly incomplete bin, like below
+                for bins in iter_stored_trace(filename, resolution, drop_last=True):
+                    reducer.write(_table(first_bin, bins, columns))
+                    first_bin += bins.shape[0]
+            else:
+                computed.append((reducer, resolution))
+        if len(computed) > 0:
+            trace = TraceBuilder([resolution for _, resolution in computed], detectors)
+            for times, dets in iter_hdf5(filename, block_size // 9):
+                trace.add_photons(times, dets)
+                # the last bin is still incomplete (and dropped at the end)
+                for (reducer, _), (first_bin, bins) in zip(computed, trace.pop_finished()):
+                    reducer.write(_table(first_bin, bins, columns))
+
+    for reducer in reducers:
+        reducer.close()
+    return [reducer.filename for reducer in reducers]
+
+
+def reduce_args(args):
+    filename = args[0]
+    start = time.perf_counter()
+    try:
+        return filename, reduce_file(*args), time.perf_counter() - start
+    except Exception as e:
+        return filename, e, 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce measurements to time,green,red CSV files')
+    parser.add_argument('inputs', nargs='+',
+                        help='CSV, raw or Photon-HDF5 files (or "input output" to reduce one file to output)')
+    parser.add_argument('-f', '--factor', type=int, action='append',
+                        help=f'samples summed up per row, can be given several times (default {RESAMPLE_FACTOR})')
+    parser.add_argument('-o', '--output-dir', help='directory for the reduced files (default next to the inputs)')
+    parser.add_argument('--rate', type=float,
+                        help='acquisition rate (samples/s) of Photon-HDF5 files with expanded timestamps '
+                             '(by default a timestamp is a sample)')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(), help='number of files reduced in parallel')
+    parser.add_argument('--block-size', type=int, default=64, help='MB of a file read at once')
+    args = parser.parse_args()
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    factors = args.factor or [RESAMPLE_FACTOR]
+    # the older "reduce_csv.py input output" (the output doesn't exist yet)
+    output = None
+    if len(args.inputs) == 2 and not os.path.exists(args.inputs[1]):
+        if len(factors) > 1 or args.output_dir is not None:
+            parser.error(f"{args.inputs[1]} not found")
+        args.inputs, output = args.inputs[:1], args.inputs[1]
+    jobs = [(f, args.output_dir, factors, args.rate, args.block_size * 1024 * 1024, output) for f in args.inputs]
+    total_start = time.perf_counter()
+    with multiprocessing.Pool(min(args.processes, max(len(jobs), 1))) as pool:
+        for filename, outputs, elapsed in pool.imap_unordered(reduce_args, jobs):
+            if isinstance(outputs, Exception):
+                print(f"{filename}: failed ({outputs})")
+                continue
+            size = os.path.getsize(filename) / 1e6
+            print(f"{filename} -> {', '.join(outputs)}: {size / elapsed:.1f} MB/s")
+    print(f"reduced {len(jobs)} files in {time.perf_counter() - total_start:.1f} s")
@@ -0,0 +1,289 @@
+"""
+Level-of-detail plotting of long binned recordings.
+
+A LODPyramid keeps the minimum, maximum and mean of every factor bins of
+the level below, starting from per-channel binned counts. A plot only needs
+the level with about one bin per pixel of the visible range: drawing each
+bin as a vertical stroke from its minimum to its maximum keeps bursts
+visible at any zoom, while only about 2x the screen width of vertices
+are uploaded.
+"""
+
+import os
+
+import numpy as np
+
+from vispy import scene
+
+
+class LODPyramid():
+    """
+    Min/max/mean decimation pyramid of counts of shape (bins, channels).
+
+    Level 0 are the counts themselves (not copied, so they may be
+    memory-mapped), level l combines factor**l bins of level 0.
+    """
+
+    def __init__(self, counts, factor=8, min_bins=1000, chunk_size=int(1e7)):
+        self.factor = factor
+        self.counts = counts
+        self.mins, self.maxs, self.means = list(), list(), list()
+        if counts.shape[0] == 0:
+            return
+
+        # level 1 is computed from the counts in chunks (of whole bins)
+        chunk_size -= chunk_size % factor
+        mins, maxs, sums = list(), list(), list()
+        for start in range(0, counts.shape[0], chunk_size):
+            chunk = np.asarray(counts[start:start+chunk_size], dtype=np.float64)
+            m, M, s = self._decimate(chunk, chunk, chunk)
+            mins.append(m)
+            maxs.append(M)
+            sums.append(s)
+        level = (np.concatenate(mins), np.concatenate(maxs), np.concatenate(sums))
+        samples = counts.shape[0]
+        while True:
+            # last bin may be incomplete
+            n = np.full(level[2].shape[0], float(self.factor ** (len(self.mins) + 1)))
+            n[-1] = samples - (n.size - 1) * n[0]
+            self.mins.append(level[0].astype(np.float32))
+            self.maxs.append(level[1].astype(np.float32))
+            self.means.append((level[2] / n[:, None]).astype(np.float32))
+            if level[2].shape[0] <= min_bins:
+                break
+            level = self._decimate(*level)
+
+    def _decimate(self, mins, maxs, sums):
+        """
+        Combines factor bins of mins, maxs and sums each.
+        """
+        padding = (-mins.shape[0]) % self.factor
+        if padding:
+            pad = ((0, padding), (0, 0))
+            mins = np.pad(mins, pad, mode='edge')
+            maxs = np.pad(maxs, pad, mode='edge')
+            sums = np.pad(sums, pad)
+        shape = (-1, self.factor, mins.shape[1])
+        return (mins.reshape(shape).min(axis=1), maxs.reshape(shape).max(axis=1),
+                sums.reshape(shape).sum(axis=1))
+
+    @property
+    def levels(self):
+        return len(self.mins) + 1
+
+    def level_data(self, level, first, last):
+        """
+        Returns min, max and mean of bins first:last of a level.
+        """
+        if level == 0:
+            counts = np.asarray(self.counts[first:last], dtype=np.float32)
+            return counts, counts, counts
+        return (self.mins[level-1][first:last], self.maxs[level-1][first:last],
+                self.means[level-1][first:last])
+
+    def level_bins(self, level):
+        if level == 0:
+            return self.counts.shape[0]
+        return self.mins[level-1].shape[0]
+
+    def select(self, x_min, x_max, max_bins):
+        """
+        Finest level showing bins x_min...x_max of level 0
+        with at most max_bins bins.
+        """
+        for level in range(self.levels):
+            if (x_max - x_min) / self.factor ** level <= max_bins:
+                return level
+        return self.levels - 1
+
+    def save(self, filename, source=None, include_counts=False):
+        """
+        Stores the levels above 0 (and the counts if include_counts,
+        e.g. if they are a trace computed from the recording) in filename
+        (.npz). If source is given, its size and modification time are
+        stored, so load can tell if the pyramid is outdated.
+        """
+        arrays = dict(factor=self.factor, samples=self.counts.shape[0])
+        if include_counts:
+            arrays['counts'] = np.asarray(self.counts)
+        if source is not None:
+            stat = os.stat(source)
+            arrays['source'] = np.array([stat.st_size, stat.st_mtime_ns])
+        for level, (m, M, mean) in enumerate(zip(self.mins, self.maxs, self.means), start=1):
+            arrays[f'min_{level}'] = m
+            arrays[f'max_{level}'] = M
+            arrays[f'mean_{level}'] = mean
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename, counts=None, source=None):
+        """
+        Loads a pyramid stored by save for counts (by default the stored ones).
+        Returns None if the file doesn't exist or doesn't match counts
+        (or the current source).
+        """
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as f:
+            if counts is None:
+                if 'counts' not in f:
+                    return None
+                counts = f['counts']
+            if int(f['samples']) != counts.shape[0]:
+                return None
+            if source is not None:
+                stat = os.stat(source)
+                if 'source' not in f or list(f['source']) != [stat.st_size, stat.st_mtime_ns]:
+                    return None
+            pyramid = cls.__new__(cls)
+            pyramid.factor = int(f['factor'])
+            pyramid.counts = counts
+            levels = sum(1 for key in f.files if key.startswith('min_'))
+            pyramid.mins = [f[f'min_{l}'] for l in range(1, levels + 1)]
+            pyramid.maxs = [f[f'max_{l}'] for l in range(1, levels + 1)]
+            pyramid.means = [f[f'mean_{l}'] for l in range(1, levels + 1)]
+        return pyramid
+
+
+def lod_filename(filename):
+    """
+    Name of the file next to a recording the pyramid of it is stored in.
+    """
+    return f'{filename}.lod.npz'
+
+
+class LODPlot():
+    """
+    Plots the channels of a LODPyramid in a vispy view, as min/max envelope
+    (vertical stroke per bin) and mean, updated whenever the camera moves.
+
+    x_scale and y_scale convert bins of level 0 and counts to plot units.
+    """
+
+    def __init__(self, view, pyramid, x_scale=1, y_scale=1, colors=('g', 'r', 'b', 'y')):
+        self.view = view
+        self.pyramid = pyramid
+        self.x_scale = x_scale
+        self.y_scale = y_scale
+        channels = pyramid.counts.shape[1]
+        self.envelopes = [scene.visuals.Line(parent=view.scene, color=colors[c % len(colors)], connect='segments')
+                          for c in range(channels)]
+        self.means = [scene.visuals.Line(parent=view.scene, color=colors[c % len(colors)])
+                      for c in range(channels)]
+        for envelope in self.envelopes:
+            envelope.opacity = 0.5
+        view.scene.transform.changed.connect(self.update)
+
+    def show_all(self):
+        """
+        Sets the camera to show the whole recording.
+        """
+        top = self.pyramid.maxs[-1].max() if len(self.pyramid.maxs) > 0 else self.pyramid.counts.max()
+        self.view.camera.rect = (0, 0, self.pyramid.counts.shape[0] * self.x_scale, max(top * self.y_scale, 1))
+        self.update()
+
+    def update(self, event=None):
+        rect = self.view.camera.rect
+        x_min, x_max = rect.left / self.x_scale, rect.right / self.x_scale
+        # about one bin per pixel
+        level = self.pyramid.select(x_min, x_max, max(self.view.size[0], 1))
+        bin_width = self.pyramid.factor ** level
+        first = int(max(x_min // bin_width, 0))
+        last = int(max(min(x_max // bin_width + 2, self.pyramid.level_bins(level)), first))
+        mins, maxs, means = self.pyramid.level_data(level, first, last)
+
+        x = (np.arange(first, last) + 0.5) * bin_width * self.x_scale
+        for c, (envelope, mean) in enumerate(zip(self.envelopes, self.means)):
+            strokes = np.empty((2 * x.size, 2), dtype=np.float32)
+            strokes[0::2, 0] = x
+            strokes[1::2, 0] = x
+            strokes[0::2, 1] = mins[:, c] * self.y_scale
+            strokes[1::2, 1] = maxs[:, c] * self.y_scale
+            envelope.set_data(strokes)
+            mean.set_data(np.vstack([x, means[:, c] * self.y_scale]).T.astype(np.float32))
+
+
+class LiveHistory():
+    """
+    Fixed-memory history of live bins for scrolling back.
+
+    Level 0 keeps the newest capacity bins, every following level keeps
+    capacity bins factor times coarser than the level below (min/max/mean),
+    i.e. older data is only available at lower resolution. Memory and the
+    cost of view() only depend on capacity and the number of levels.
+    """
+
+    def __init__(self, history_bins, capacity, channels, factor=4):
+        self.capacity = capacity
+        self.factor = factor
+        levels = 1
+        while capacity * factor ** (levels - 1) < history_bins:
+            levels += 1
+        shape = (levels, capacity, channels)
+        self.mins = np.full(shape, np.nan, dtype=np.float32)
+        self.maxs = np.full(shape, np.nan, dtype=np.float32)
+        self.means = np.full(shape, np.nan, dtype=np.float32)
+        # bins written per level
+        self.count = [0] * levels
+        # bins of the level below not yet combined into a bin of this level
+        self.pending = [None] * levels
+
+    @property
+    def levels(self):
+        return len(self.count)
+
+    def append(self, bins):
+        """
+        Adds new bins of shape (bins, channels).
+        """
+        bins = np.asarray(bins, dtype=np.float64)
+        mins, maxs, sums = bins, bins, bins
+        for level in range(self.levels):
+            self._write(level, mins, maxs, sums / self.factor ** level)
+            if level + 1 == self.levels:
+                break
+
+            if self.pending[level + 1] is not None:
+                pending_mins, pending_maxs, pending_sums = self.pending[level + 1]
+                mins = np.concatenate((pending_mins, mins))
+                maxs = np.concatenate((pending_maxs, maxs))
+                sums = np.concatenate((pending_sums, sums))
+            full = mins.shape[0] - mins.shape[0] % self.factor
+            self.pending[level + 1] = (mins[full:], maxs[full:], sums[full:])
+            if full == 0:
+                break
+            shape = (-1, self.factor, mins.shape[1])
+            mins = mins[:full].reshape(shape).min(axis=1)
+            maxs = maxs[:full].reshape(shape).max(axis=1)
+            sums = sums[:full].reshape(shape).sum(axis=1)
+
+    def _write(self, level, mins, maxs, means):
+        n = mins.shape[0]
+        if n > self.capacity:
+            mins, maxs, means = mins[-self.capacity:], maxs[-self.capacity:], means[-self.capacity:]
+        ring = (self.count[level] + n - mins.shape[0] + np.arange(mins.shape[0])) % self.capacity
+        self.mins[level, ring] = mins
+        self.maxs[level, ring] = maxs
+        self.means[level, ring] = means
+        self.count[level] += n
+
+    def view(self, x_min, x_max, max_bins):
+        """
+        Finds the finest level that shows bins x_min...x_max (counted from
+        the first bin appended) with at most max_bins bins and still holds
+        x_min (or the coarsest level).
+        Returns the bin width of the level and the positions (centers), mins,
+        maxs and means of the bins of the level in that range.
+        """
+        for level in range(self.levels):
+            width = self.factor ** level
+            if (x_max - x_min) / width > max_bins:
+                continue
+            oldest = (self.count[level] - self.capacity) * width
+            if x_min >= oldest:
+                break
+        first = int(max(x_min // width, self.count[level] - self.capacity, 0))
+        last = int(max(min(x_max // width + 2, self.count[level]), first))
+        ring = np.arange(first, last) % self.capacity
+        x = (np.arange(first, last) + 0.5) * width
+        return width, x, self.mins[level, ring], self.maxs[level, ring], self.means[level, ring]
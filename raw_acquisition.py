@@ -0,0 +1,22 @@
+import time
+
+import raw_file
+from config import *
+from ring_buffer import StorageConsumer
+
+
+def open_writer():
+    return raw_file.RawWriter(f'measurement_{int(time.time())}', ACQUISITION_RATE, CHANNELS)
+
+
+def write(writer, first_sample, counts):
+    # the file has no time column, lost samples are filled with zeros
+    writer.append(counts)
+
+
+def close_writer(writer):
+    writer.close()
+    print(f"saved {writer.filename}")
+
+
+storage = StorageConsumer("Raw", open_writer, write, close_writer)
@@ -0,0 +1,158 @@
+"""
+Compact binary recording of the raw counter values.
+
+A file consists of a HEADER_SIZE byte header followed by the counter values
+exactly as they are interleaved in the ring buffer (one value per channel
+per sample) stored as little endian COUNT_DTYPE.
+Since every sample has the same size, the file can be memory-mapped
+and indexed by time directly.
+
+Samples lost to ring buffer overruns are stored as zeros. Where they are
+is recorded in a table of (first lost sample, lost samples) pairs
+(little endian uint64) following the samples.
+"""
+
+import time
+
+import numpy as np
+
+MAGIC = b'MCCRAW01'
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('channels', '<u4'),
+    ('acquisition_rate', '<u8'),
+    ('start_time', '<f8'),  # unix time of the first sample
+    ('samples', '<u8'),     # written on close, 0 if the file wasn't closed
+    ('overruns', '<u8'),    # number of entries in the overrun table
+])
+
+COUNT_DTYPE = np.dtype('<u2')
+COUNT_MAX = np.iinfo(COUNT_DTYPE).max
+
+
+class RawWriter():
+    """
+    Appends interleaved counter values to a raw file.
+    """
+
+    def __init__(self, fname, acquisition_rate, channels, start_time=None):
+        self.filename = f'{fname}.raw'
+        self.channels = channels
+        self.samples = 0
+        self.saturated = False
+        self.overruns = list()
+
+        self.header = np.zeros(1, dtype=HEADER_DTYPE)
+        self.header['magic'] = MAGIC
+        self.header['channels'] = channels
+        self.header['acquisition_rate'] = acquisition_rate
+        self.header['start_time'] = time.time() if start_time is None else start_time
+
+        self.file = open(self.filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        self.file.write(self.header.tobytes().ljust(HEADER_SIZE, b'\0'))
+
+    def append(self, counts):
+        """
+        Writes counts, which have to contain whole samples.
+        """
+        if not self.saturated and counts.size > 0 and counts.max() > COUNT_MAX:
+            print(f"Warning: more than {COUNT_MAX} counts in one sample, saturating!")
+            self.saturated = True
+        self.file.write(np.minimum(counts, COUNT_MAX).astype(COUNT_DTYPE))
+        self.samples += counts.size // self.channels
+
+    def add_overrun(self, sample, samples):
+        """
+        Records that samples starting at sample have been lost
+        and fills them with zeros.
+        """
+        self.overruns.append((sample, samples))
+        zeros = np.zeros(min(samples, int(1e6)) * self.channels, dtype=COUNT_DTYPE)
+        remaining = samples
+        while remaining > 0:
+            n = min(remaining, zeros.size // self.channels)
+            self.file.write(zeros[:n * self.channels])
+            remaining -= n
+        self.samples += samples
+
+    def close(self):
+        self.file.write(np.array(self.overruns, dtype='<u8').reshape(-1, 2))
+        self.header['samples'] = self.samples
+        self.header['overruns'] = len(self.overruns)
+        self.file.seek(0)
+        self._write_header()
+        self.file.close()
+
+
+def _read_header(filename):
+    header = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+    if header.size != 1 or header['magic'][0] != MAGIC:
+        raise ValueError(f"{filename} is not a raw counts file")
+    return header[0]
+
+
+def load_raw(filename):
+    """
+    Memory-map a raw file.
+
+    Parameters
+    ----------
+    filename : str
+        Name of file to open.
+
+    Returns
+    -------
+    counts : np.memmap
+        Read-only array of shape (samples, channels), counts[t, c] are the
+        counts of channel c in sample t.
+    acquisition_rate : int
+        Samples per second.
+    start_time : float
+        Unix time at which the first sample was recorded.
+
+    """
+    header = _read_header(filename)
+    channels = int(header['channels'])
+
+    samples = int(header['samples'])
+    if samples == 0:
+        # not closed properly (e.g. the acquisition crashed),
+        # use everything but an incomplete last sample
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            size = f.tell()
+        samples = (size - HEADER_SIZE) // (COUNT_DTYPE.itemsize * channels)
+    if samples == 0:
+        counts = np.zeros((0, channels), dtype=COUNT_DTYPE)
+    else:
+        counts = np.memmap(filename, dtype=COUNT_DTYPE, mode='r', offset=HEADER_SIZE,
+                           shape=(samples, channels))
+    return counts, int(header['acquisition_rate']), float(header['start_time'])
+
+
+def load_overruns(filename):
+    """
+    Read where samples of a raw file have been lost to ring buffer overruns.
+
+    Parameters
+    ----------
+    filename : str
+        Name of file to open.
+
+    Returns
+    -------
+    overruns : np.ndarray[np.int64]
+        Array of shape (overruns, 2), each row is the first lost sample
+        and the number of lost samples.
+
+    """
+    header = _read_header(filename)
+    offset = HEADER_SIZE + int(header['samples']) * int(header['channels']) * COUNT_DTYPE.itemsize
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        overruns = np.fromfile(f, dtype='<u8', count=2 * int(header['overruns']))
+    return overruns.reshape(-1, 2).astype(np.int64)
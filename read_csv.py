@@ -0,0 +1,215 @@
+"""
+Fast loading of measurement CSV files (as written by csv_acquisition).
+
+Rows are parsed by a compiled kernel, a block of the file at a time,
+straight into a preallocated int64 table. The table is kept in a .npy
+sidecar next to the CSV file, named after the size and modification time
+of the CSV file, so it is parsed only once and memory-mapped afterwards.
+"""
+
+import glob
+import os
+
+import numba
+import numpy as np
+
+BLOCK_SIZE = 64 * 1024 * 1024
+
+
+@numba.jit(nopython=True, nogil=True)
+def _count_rows(data, in_row):
+    """
+    Counts the non-empty rows ending in data.
+    in_row tells if the previous block ended within a row,
+    returns the number of rows and whether data ends within a row.
+    """
+    rows = 0
+    for c in data:
+        if c == 10:  # '\n'
+            if in_row:
+                rows += 1
+            in_row = False
+        elif c != 13:  # '\r'
+            in_row = True
+    return rows, in_row
+
+
+@numba.jit(nopython=True, nogil=True)
+def _parse_rows(data, out, row):
+    """
+    Parses the comma separated non-negative integers of the complete rows
+    in data into out, starting at out[row]. Empty rows are skipped.
+    Returns the row after the last parsed one and 0, or stops at a malformed
+    row and returns it and its number of columns (-1 for invalid characters).
+    """
+    columns = out.shape[1]
+    col = 0
+    value = 0
+    in_row = False
+    for c in data:
+        if c >= 48 and c <= 57:  # '0'...'9'
+            value = value * 10 + c - 48
+            in_row = True
+        elif c == 44:  # ','
+            col += 1
+            if col >= columns:
+                # count the columns of the row for the error
+                continue
+            out[row, col - 1] = value
+            value = 0
+            in_row = True
+        elif c == 10:  # '\n'
+            if in_row:
+                if col != columns - 1:
+                    return row, col + 1
+                out[row, col] = value
+                row += 1
+            value = 0
+            col = 0
+            in_row = False
+        elif c != 13:  # '\r'
+            return row, -1
+    return row, 0
+
+
+def _check_parsed(filename, row, columns, expected):
+    """
+    Raises a ValueError for a malformed row reported by _parse_rows.
+    """
+    if columns == -1:
+        raise ValueError(f"{filename}: invalid character in row {row + 1}")
+    if columns != 0:
+        raise ValueError(f"{filename}: row {row + 1} has {columns} columns instead of {expected}")
+
+
+def _blocks(f, block_size=BLOCK_SIZE):
+    """
+    Yields the rest of the file f in blocks of whole lines as uint8 arrays.
+    """
+    rest = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end > 0:
+            yield np.frombuffer(block[:end], dtype=np.uint8)
+    if rest.strip():
+        yield np.frombuffer(rest + b'\n', dtype=np.uint8)
+
+
+def read_header(filename):
+    """
+    Returns the column names of a CSV file.
+    """
+    with open(filename, 'rb') as f:
+        return f.readline().decode().strip().split(',')
+
+
+def table_shape(filename):
+    """
+    Returns (rows, columns) of a CSV file (without the header).
+    """
+    columns = len(read_header(filename))
+    rows = 0
+    in_row = False
+    with open(filename, 'rb') as f:
+        f.readline()
+        for block in _blocks(f):
+            n, in_row = _count_rows(block, in_row)
+            rows += n
+    return rows, columns
+
+
+def parse_csv(filename, out=None):
+    """
+    Parses all rows (but the header) of a CSV file into an int64 array
+    of shape (rows, columns). Writes into out if given (e.g. a memory-mapped
+    array), which has to have the right shape.
+    """
+    if out is None:
+        out = np.empty(table_shape(filename), dtype=np.int64)
+
+    row = 0
+    with open(filename, 'rb') as f:
+        f.readline()
+        for block in _blocks(f):
+            row, columns = _parse_rows(block, out, row)
+            _check_parsed(filename, row, columns, out.shape[1])
+    return out
+
+
+def iter_csv(filename, block_size=BLOCK_SIZE):
+    """
+    Yields the rows (but the header) of a CSV file as int64 arrays of shape
+    (rows, columns), one block of the file at a time, without loading
+    (or caching) the whole file.
+    """
+    columns = len(read_header(filename))
+    # rows of the blocks before, for errors
+    first_row = 0
+    with open(filename, 'rb') as f:
+        f.readline()
+        for block in _blocks(f, block_size):
+            rows, _ = _count_rows(block, False)
+            out = np.empty((rows, columns), dtype=np.int64)
+            row, bad_columns = _parse_rows(block, out, 0)
+            _check_parsed(filename, first_row + row, bad_columns, columns)
+            first_row += rows
+            yield out
+
+
+def sidecar_filename(filename):
+    """
+    Name of the sidecar of the current version of a CSV file.
+    """
+    stat = os.stat(filename)
+    return f'{filename}.{stat.st_size}-{stat.st_mtime_ns}.npy'
+
+
+def load_csv_table(filename, cache=True):
+    """
+    Load the rows of a CSV file as int64 array of shape (rows, columns).
+
+    Parameters
+    ----------
+    filename : str
+        Name of csv file to open.
+    cache : bool, optional
+        Whether to use (and create) the sidecar. The default is True.
+
+    Returns
+    -------
+    table : np.ndarray[np.int64]
+        The rows, memory-mapped read-only if loaded from the sidecar.
+
+    """
+    if not cache:
+        return parse_csv(filename)
+
+    sidecar = sidecar_filename(filename)
+    if os.path.exists(sidecar):
+        return np.load(sidecar, mmap_mode='r')
+
+    # sidecars of older versions of the file are outdated
+    for outdated in glob.glob(f'{glob.escape(filename)}.*-*.npy'):
+        os.remove(outdated)
+
+    tmp = f'{sidecar}.tmp'
+    try:
+        table = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int64, shape=table_shape(filename))
+    except OSError as e:
+        print(f"Cannot create {sidecar} ({e}), parsing without cache")
+        return parse_csv(filename)
+    try:
+        parse_csv(filename, out=table)
+    except:
+        del table
+        os.remove(tmp)
+        raise
+    table.flush()
+    del table
+    os.replace(tmp, sidecar)
+    return np.load(sidecar, mmap_mode='r')
@@ -0,0 +1,199 @@
+"""
+Bookkeeping for consumers of the counter's ring buffer.
+
+All positions are absolute, i.e. the number of values (not samples) the
+counter has transferred since the scan started. The value at position p
+lives at buf[p % PLAIN_BUFFER_SIZE] until the counter reaches
+p + PLAIN_BUFFER_SIZE and overwrites it.
+"""
+
+import numpy as np
+
+from config import *
+
+
+class RingReader():
+    """
+    Hands out the spans of the ring buffer that are ready to be read
+    and detects if the consumer fell so far behind that data was overwritten.
+
+    Data is handed out once at least min_chunk_size values are available,
+    always in multiples of granularity values (e.g. whole samples or bins).
+    """
+
+    def __init__(self, min_chunk_size=MIN_CHUNK_SIZE, granularity=CHANNELS):
+        self.min_chunk_size = max(min_chunk_size, granularity)
+        self.granularity = granularity
+        self.consumed = None
+        # total values lost to overruns
+        self.lost = 0
+
+    def skip_overwritten(self, produced):
+        """
+        Call with the current transfer count before reading.
+        If data that was not consumed yet has been overwritten already,
+        continues with intact data and returns the number of lost values.
+        The oldest intact data is where the counter writes next, so reading
+        continues MIN_CHUNK_SIZE values later, which is not overwritten
+        while it is read.
+        """
+        if self.consumed is None:
+            # start with the data that arrives from now on
+            self.consumed = produced - produced % self.granularity
+            return 0
+
+        oldest = produced - PLAIN_BUFFER_SIZE
+        if self.consumed >= oldest:
+            return 0
+
+        skip_to = oldest + MIN_CHUNK_SIZE
+        skip_to += (-skip_to) % self.granularity
+        lost = skip_to - self.consumed
+        self.lost += lost
+        self.consumed = skip_to
+        return lost
+
+    def skip_lost_samples(self, produced, writer, first_sample, max_samples):
+        """
+        skip_overwritten for storage backends: reports the lost samples
+        (at most max_samples, e.g. the rest of the measurement) and records
+        them with writer.add_overrun(first_sample, samples).
+        Returns the number of lost samples.
+        """
+        lost = min(self.skip_overwritten(produced) // CHANNELS, max_samples)
+        if lost <= 0:
+            return 0
+        print(f"Overrun: lost {lost} samples")
+        writer.add_overrun(first_sample, lost)
+        return lost
+
+    def advance(self, produced):
+        """
+        Consumes everything available up to produced.
+        Returns (transfer_from, transfer_to) as indices into the buffer,
+        transfer_to < transfer_from if the span wraps around.
+        Returns None if less than min_chunk_size values are available.
+        """
+        available = produced - self.consumed
+        available -= available % self.granularity
+        if available < self.min_chunk_size:
+            return None
+        transfer_from = self.consumed % PLAIN_BUFFER_SIZE
+        self.consumed += available
+        return transfer_from, self.consumed % PLAIN_BUFFER_SIZE
+
+    def spans(self, produced):
+        """
+        Consumes everything available up to produced.
+        Yields (start, end) such that buf[start:end] is contiguous,
+        i.e. two spans if the data wraps around the end of the buffer.
+        """
+        available = self.advance(produced)
+        if available is None:
+            return
+        transfer_from, transfer_to = available
+        if transfer_to > transfer_from:
+            yield transfer_from, transfer_to
+        else:
+            yield transfer_from, PLAIN_BUFFER_SIZE
+            if transfer_to > 0:
+                yield 0, transfer_to
+
+
+class StorageConsumer():
+    """
+    Stores the ring buffer during a measurement, independent of the format.
+
+    A storage backend provides
+      open_fn() -> writer, called when a measurement starts,
+      write_fn(writer, first_sample, counts) for whole samples of the buffer,
+      close_fn(writer) when the measurement ends.
+    The writer has to record lost samples with add_overrun(first_sample, samples).
+
+    update_callback_fn is the AcquisitionThread callback, toggle_acquisition
+    starts and stops a measurement (with the thread's lock held).
+    """
+
+    def __init__(self, name, open_fn, write_fn, close_fn):
+        self.name = name
+        self.open_fn = open_fn
+        self.write_fn = write_fn
+        self.close_fn = close_fn
+        self.acquisition = False
+        self.reader = None
+        self.writer = None
+        # samples stored (or lost) since the measurement started
+        self.current_time = 0
+        # samples lost to ring buffer overruns in the current (or last) measurement
+        self.lost_samples = 0
+
+    def toggle_acquisition(self):
+        self.acquisition = not self.acquisition
+        print(f"Acquisition as {self.name}", "started" if self.acquisition else "stopped")
+        if self.acquisition:
+            # User just turned on acquisition
+            self.reader = RingReader()
+            self.lost_samples = 0
+            self.writer = self.open_fn()
+        else:
+            # User just turned off acquisition
+            print("amount of timestamps:", self.current_time)
+            print("lost samples:", self.lost_samples)
+            writer = self.writer
+            # reset measurement
+            self.writer = None
+            self.current_time = 0
+            self.close_fn(writer)
+
+    def update_callback_fn(self, buf, produced, total_seconds):
+        """
+        Stores what the counter has produced since the last call,
+        at most total_seconds of the measurement.
+        Returns False if the end of the acquisition has been reached
+        (the measurement is stopped then).
+        """
+        if not self.acquisition:
+            return True
+
+        if self.writer is None:
+            print("Error in Acquisition, please restart!")
+            return True
+
+        total_samples = int(total_seconds * ACQUISITION_RATE)
+
+        # don't account for samples after the end of the acquisition
+        lost = self.reader.skip_lost_samples(produced, self.writer, self.current_time,
+                                             total_samples - self.current_time)
+        self.lost_samples += lost
+        self.current_time += lost
+
+        for start, end in self.reader.spans(produced):
+            remaining = total_samples - self.current_time
+            if remaining <= 0:
+                break
+            samples = min((end - start) // CHANNELS, remaining)
+            self.write_fn(self.writer, self.current_time, buf[start:start + samples * CHANNELS])
+            self.current_time += samples
+
+        if self.current_time >= total_samples:
+            # End of acquisition has been reached
+            self.toggle_acquisition()
+            return False
+        return True
+
+
+def bin_span(buf, transfer_from, transfer_to, samples_per_bin, channels=CHANNELS):
+    """
+    Sums the interleaved values of buf[transfer_from:transfer_to] into bins
+    of samples_per_bin samples, wrapping around the end of buf if transfer_to
+    <= transfer_from (equal means a whole cycle, like RingReader.advance).
+    Incomplete bins at the end are ignored.
+    Returns an array of shape (bins, channels).
+    """
+    if transfer_to > transfer_from:
+        span = buf[transfer_from:transfer_to]
+    else:
+        span = np.concatenate((buf[transfer_from:], buf[:transfer_to]))
+    bin_values = samples_per_bin * channels
+    span = span[:span.size - span.size % bin_values]
+    return span.reshape(-1, samples_per_bin, channels).sum(axis=1)
@@ -13,8 +13,10 @@ import traceback
 import numpy as np
 
 import visualize_vispy_lines as visualizer_backend
+from acquisition_thread import AcquisitionThread
 import hdf_acquisition
 import csv_acquisition
+import raw_acquisition
 
 from config import *
 
@@ -28,11 +30,19 @@ try:
 except:
     print("uldaq not installed, must proceed with mock data")
 
+# Storage type (as selected in the visualizer) -> ring_buffer.StorageConsumer
+acquisition_backends = {
+    "HDF5": hdf_acquisition.storage,
+    "CSV": csv_acquisition.storage,
+    "Raw": raw_acquisition.storage,
+}
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(description="Calculate auto/cross corelation of times")
     parser.add_argument('-c', '--cross', help="Display cross correlation", action="store_true")
     parser.add_argument('-a', '--auto', help="Display auto correlation", action="store_true")
+    parser.add_argument('-b', '--bursts', help="Display burst size and proximity ratio histograms", action="store_true")
     args = parser.parse_args()
     
     print("(C) Philipp Klocke")
@@ -43,6 +53,7 @@ def main():
         counter_api.setup()
         buf = counter_api.get_buf()
         get_idx_fn = counter_api.get_idx_fn
+        get_total_count_fn = counter_api.get_total_count_fn
 
         scan_rate = counter_api.start_scan()
         print(f"scanning with {scan_rate}/s")
@@ -60,6 +71,7 @@ def main():
                 threading.Thread.__init__(self)
                 self.buf = np.zeros(PLAIN_BUFFER_SIZE, dtype=int)
                 self.idx = 0
+                self.total_count = 0
                 self.stop = False
 
             def run(self):
@@ -77,46 +89,80 @@ def main():
                                 buf[self.idx+CHANNELS*loc+n] += 1
                     
                     
-                    self.idx = (self.idx + SAMPLES_PER_BIN*CHANNELS) % PLAIN_BUFFER_SIZE
+                    self.total_count += SAMPLES_PER_BIN*CHANNELS
+                    self.idx = self.total_count % PLAIN_BUFFER_SIZE
                     time.sleep(1 / BIN_SIZE)
 
             def get_idx(self):
                 return self.idx
 
+            def get_total_count(self):
+                return self.total_count
+
             def get_buf(self):
                 return self.buf
 
         mock = MockCounter()
         buf = mock.get_buf()
         get_idx_fn = mock.get_idx
+        get_total_count_fn = mock.get_total_count
         mock.start()
 
-    def update_callback_fn(buf, valid_idx):
-        cont = True
-        if visualizer_backend.measurement_type == "HDF5":
-            cont = hdf_acquisition.update_callback_fn(buf, valid_idx, visualizer_backend.measurement_time_seconds)
-        else:
-            cont = csv_acquisition.update_callback_fn(buf, valid_idx, visualizer_backend.measurement_time_seconds)
+    def update_callback_fn(buf, produced):
+        backend = acquisition_backends[visualizer_backend.measurement_type]
+        cont = backend.update_callback_fn(buf, produced, visualizer_backend.measurement_time_seconds)
         if not cont:
             visualizer_backend.stop_measurement()
 
+    def storage_error_fn(callback_fn, e):
+        # a failed write ends the measurement, keeping what has been stored
+        backend = acquisition_backends[visualizer_backend.measurement_type]
+        if backend.acquisition:
+            try:
+                backend.toggle_acquisition()
+            except Exception:
+                traceback.print_exc()
+        visualizer_backend.stop_measurement(f"Measurement stopped, storage failed: {e!r}")
+
+    def analysis_error_fn(callback_fn, e):
+        analysis_thread.callbacks.remove(callback_fn)
+        visualizer_backend.report_error(f"Live analysis stopped: {e!r}")
+
+    # Storage runs in its own thread, so the GUI frame rate has no effect
+    # on data integrity. Binning for the live view, correlation and burst
+    # search read the ring buffer in another thread, so they don't delay
+    # storage either (and skip data if they fall behind).
+    acquisition_thread = AcquisitionThread(buf, get_total_count_fn, [update_callback_fn],
+                                           error_fn=storage_error_fn, name="storage")
+    analysis_thread = AcquisitionThread(buf, get_total_count_fn, [visualizer_backend.bin_callback_fn,
+                                                                  visualizer_backend.corr_callback_fn,
+                                                                  visualizer_backend.burst_callback_fn],
+                                        error_fn=analysis_error_fn, name="live analysis")
+
     def toggle_acquisition():
         # TODO: rather than toggle we should probably call stop/start here.
-        if visualizer_backend.measurement_type == "HDF5":
-            hdf_acquisition.toggle_acquisition()
-        else:
-            csv_acquisition.toggle_acquisition()
+        with acquisition_thread.lock:
+            acquisition_backends[visualizer_backend.measurement_type].toggle_acquisition()
     
     if CHANNELS == 1 and args.cross:
         print("Cannot show cross correlation for single channel setups")
     else:
+        acquisition_thread.start()
+        analysis_thread.start()
         visualizer_backend.visualize(
                 buf,
                 get_idx_fn,
-                update_callback_fn,
                 acquisition_fun=toggle_acquisition,
                 correlate=args.cross or args.auto,
-                cross=args.cross, auto=args.auto)
+                cross=args.cross, auto=args.auto, bursts=args.bursts,
+                lost_samples_fn=lambda: acquisition_backends[visualizer_backend.measurement_type].lost_samples)
+        for thread in (acquisition_thread, analysis_thread):
+            thread.stop = True
+            thread.join()
+        # save a measurement still running when the window was closed
+        backend = acquisition_backends[visualizer_backend.measurement_type]
+        if backend.acquisition:
+            backend.toggle_acquisition()
 
     print("Ended Visualization")
 
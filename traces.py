@@ -0,0 +1,190 @@
+"""
+Intensity traces (photons per time bin and detector) at several resolutions.
+
+A TraceBuilder is fed consecutive chunks of photons (sorted timestamps and
+detectors, e.g. from correlate.iter_hdf5) or of counts (as in raw or csv
+files, one row per sample) and bins them at every resolution in one pass
+(np.bincount / np.add.reduceat), so a trace of a long measurement is built
+with bounded work per photon. For plotting, a trace is decimated by
+lod.LODPyramid.
+
+PhotonHDF5Writer stores such traces in the recordings (TRACES_GROUP),
+the functions below read them instead of binning all photons again.
+"""
+
+import numpy as np
+import tables as tb
+
+# group of the traces in photon hdf5 files
+TRACES_GROUP = '/user/traces'
+
+
+class TraceBuilder():
+    """
+    Bins photons or counts of consecutive chunks at several resolutions.
+
+    For every resolution (bin width in units of the timestamps) it keeps
+    the finished bins and the bins still receiving photons.
+    Bins before the last photon of a chunk are finished, since the following
+    chunks only contain later photons.
+    """
+
+    def __init__(self, resolutions, detectors=2):
+        self.resolutions = list(resolutions)
+        self.detectors = detectors
+        # index of the first bin in current, per level
+        self.start = [0] * len(self.resolutions)
+        self.current = [np.zeros((0, detectors), dtype=np.int64) for _ in self.resolutions]
+        self.finished = [list() for _ in self.resolutions]
+
+    def _add(self, level, first_bin, bins):
+        """
+        Adds bins starting at first_bin to current, moves the bins before
+        the last one of bins to finished.
+        """
+        offset = first_bin - self.start[level]
+        current = self.current[level]
+        end = offset + bins.shape[0]
+        if end > current.shape[0]:
+            current = np.concatenate((current, np.zeros((end - current.shape[0], self.detectors), dtype=np.int64)))
+        current[offset:end] += bins
+
+        done = end - 1
+        if done > 0:
+            self.finished[level].append(current[:done])
+            current = current[done:]
+            self.start[level] += done
+        self.current[level] = current
+
+    def add_photons(self, times, dets):
+        """
+        Adds photons (times monotonically increasing and not before
+        the photons added so far).
+        """
+        if times.size == 0:
+            return
+        for level, resolution in enumerate(self.resolutions):
+            idx = times // resolution
+            first_bin = idx[0]
+            bins = np.bincount((idx - first_bin) * self.detectors + dets,
+                               minlength=(idx[-1] - first_bin + 1) * self.detectors)
+            self._add(level, first_bin, bins.reshape(-1, self.detectors))
+
+    def add_counts(self, counts, first_sample=0):
+        """
+        Adds counts of shape (samples, detectors), counts[i] being the counts
+        at time first_sample + i.
+        """
+        if counts.shape[0] == 0:
+            return
+        counts = np.asarray(counts[:, :self.detectors], dtype=np.int64)
+        for level, resolution in enumerate(self.resolutions):
+            # first sample of every bin in counts
+            first_full = (-first_sample) % resolution
+            starts = np.arange(first_full, counts.shape[0], resolution)
+            if first_full != 0:
+                starts = np.concatenate(([0], starts))
+            bins = np.add.reduceat(counts, starts, axis=0)
+            self._add(level, first_sample // resolution, bins)
+
+    def finish(self):
+        """
+        Marks the bins still receiving photons as finished,
+        at the end of the measurement.
+        """
+        for level in range(len(self.resolutions)):
+            current = self.current[level]
+            if current.shape[0] > 0:
+                self.finished[level].append(current)
+                self.start[level] += current.shape[0]
+                self.current[level] = current[:0]
+
+    def pop_finished(self):
+        """
+        Returns the bins finished since the last call (per level, with the
+        index of their first bin) and forgets them, e.g. to store them elsewhere.
+        Popped bins are not part of levels() anymore.
+        """
+        popped = list()
+        for level in range(len(self.resolutions)):
+            bins = self.finished[level]
+            count = sum(b.shape[0] for b in bins)
+            first_bin = self.start[level] - count
+            if len(bins) == 0:
+                bins = np.zeros((0, self.detectors), dtype=np.int64)
+            else:
+                bins = np.concatenate(bins)
+            popped.append((first_bin, bins))
+            self.finished[level] = list()
+        return popped
+
+    def levels(self):
+        """
+        Returns the traces of all levels, each of shape (bins, detectors)
+        starting at time 0 (including the unfinished last bin).
+        """
+        levels = list()
+        for level in range(len(self.resolutions)):
+            bins = self.finished[level] + [self.current[level]]
+            count = sum(b.shape[0] for b in self.finished[level])
+            skipped = self.start[level] - count
+            levels.append(np.concatenate([np.zeros((skipped, self.detectors), dtype=np.int64)] + bins))
+        return levels
+
+
+def _stored_levels(f):
+    if TRACES_GROUP not in f:
+        return []
+    levels = list(f.get_node(TRACES_GROUP))
+    return sorted(levels, key=lambda level: int(level.attrs.resolution))
+
+
+def stored_resolutions(filename):
+    """
+    Resolutions (in timestamp units) of the traces stored in a photon hdf5
+    file, finest first. Empty for files without stored traces.
+    """
+    with tb.open_file(filename, 'r') as f:
+        return [int(level.attrs.resolution) for level in _stored_levels(f)]
+
+
+def load_stored_trace(filename, max_bins):
+    """
+    Reads the finest trace stored in a photon hdf5 file with at most max_bins
+    bins (or the coarsest one).
+    Returns (resolution, counts of shape (bins, detectors)),
+    (None, None) for files without stored traces.
+    """
+    with tb.open_file(filename, 'r') as f:
+        levels = _stored_levels(f)
+        if len(levels) == 0:
+            return None, None
+        level = next((level for level in levels if level.nrows <= max_bins), levels[-1])
+        return int(level.attrs.resolution), level.read().astype(np.int64)
+
+
+def iter_stored_trace(filename, resolution, drop_last=False, chunk_size=int(1e7)):
+    """
+    Yields consecutive chunks of the trace at resolution (in timestamp units)
+    of a photon hdf5 file, summed up from a stored trace. The resolution has
+    to be a multiple of one of the stored_resolutions.
+
+    The last bin contains the last photon and may be incomplete, drop_last
+    skips it (like a TraceBuilder that wasn't finished).
+    """
+    with tb.open_file(filename, 'r') as f:
+        level = next(level for level in reversed(_stored_levels(f))
+                     if resolution % int(level.attrs.resolution) == 0)
+        factor = resolution // int(level.attrs.resolution)
+        rows = level.nrows
+        if drop_last:
+            # bins before the one containing the last photon
+            rows = max(rows - 1, 0) // factor * factor
+        chunk_size = max(chunk_size // factor, 1) * factor
+        for start in range(0, rows, chunk_size):
+            counts = level.read(start, min(start + chunk_size, rows)).astype(np.int64)
+            full = counts.shape[0] - counts.shape[0] % factor
+            bins = counts[:full].reshape(-1, factor, counts.shape[1]).sum(axis=1)
+            if full < counts.shape[0]:
+                bins = np.concatenate((bins, counts[full:].sum(axis=0, keepdims=True)))
+            yield bins
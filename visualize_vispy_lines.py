@@ -1,7 +1,8 @@
 import numpy as np
+import queue
 import sys
 
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 from time import sleep
 
 from vispy import app, scene
@@ -16,9 +17,12 @@ try:
 except:
     has_align = False
 
-from correlate import pcorrelate, proc_buffer
+from correlate import MultiTauCorrelator, proc_raw
+from ring_buffer import RingReader, bin_span
+from lod import LiveHistory
+from burst_search import BurstSearch, BurstHistograms, max_window_duration
 
-# vertex positions of data to draw
+# at most N bins are drawn per line and frame
 N = CANVAS_SIZE[0]
 
 # Leaves some space for the axes
@@ -26,60 +30,149 @@ N = CANVAS_SIZE[0]
 GRID_COLS = 10
 GRID_ROWS = 7
 
-# green channel
-pos_green = np.zeros((N, 2), dtype=np.float32)
-pos_green[:, 0] = np.linspace(0, N, N)
-pos_green[:, 1] = None
+# The last HISTORY_SECONDS of bins, older ones at lower resolution,
+# so scrolling back doesn't need a full resolution vertex array
+history = LiveHistory(HISTORY_SECONDS * BIN_SIZE, 2 * N, CHANNELS)
 
-# red channel
-pos_red = np.zeros((N, 2), dtype=np.float32)
-pos_red[:, 0] = np.linspace(0, N, N)
-pos_red[:, 1] = None
 
+def transfer_data(buf, transfer_from, transfer_to) -> np.ndarray:
+    """
+    Bins data of buf, starting from transfer_from to transfer_to
+    (wrapping around if transfer_to <= transfer_from).
+    Returns the bins (shape (bins, CHANNELS)).
+    """
+
+    # print("transferring from buf[", transfer_from, "to", transfer_to, "]")
+
+    return bin_span(buf, transfer_from, transfer_to, SAMPLES_PER_BIN)
 
-def transfer_data(buf, canv_idx, transfer_from, transfer_to) -> (int, int):
+
+# Bins are computed by the acquisition thread and drawn by the GUI
+bins_queue = queue.Queue()
+bins_reader = RingReader(min_chunk_size=0, granularity=SAMPLES_PER_BIN * CHANNELS)
+
+
+def bin_callback_fn(buf, produced):
     """
-    Transfers data to canvas buffer, starting from transfer_from to transfer_to
-    Returns new transfer_idx, new idx (to canvas) and sets pos_green, pos_red.
+    Acquisition thread callback, publishes finished bins to bins_queue.
     """
+    # missing data in the live view is no problem
+    bins_reader.skip_overwritten(produced)
+    span = bins_reader.advance(produced)
+    if span is not None:
+        bins_queue.put(transfer_data(buf, *span))
+
 
-    # print("transferring from buf[", transfer_from, "to", transfer_to, "] to canvas[", idx, "]")
+# Live correlation, fed by the acquisition thread as well
+correlator = None
+corr_reader = RingReader(min_chunk_size=0)
 
-    if transfer_from == transfer_to:
-        # TODO: could we miss a whole cycle? Very low probability
-        return transfer_from, canv_idx
 
-    # print(f"{transfer_from}-{transfer_to}")
+def corr_callback_fn(buf, produced):
+    """
+    Acquisition thread callback, feeds new samples to the correlator.
+    """
+    if correlator is None:
+        return
+    if corr_reader.skip_overwritten(produced) > 0:
+        correlator.gap()
+    for start, end in corr_reader.spans(produced):
+        correlator.feed(buf[start:end].reshape(-1, CHANNELS))
 
-    transferrable_samples = transfer_to - transfer_from
-    if transferrable_samples < 0:
-        # handle buffer overrun (restart from the left)
-        transferrable_samples += PLAIN_BUFFER_SIZE
 
-    transferrable_samples = transferrable_samples // CHANNELS
+def reset_correlation():
+    """
+    Restarts averaging the correlation, e.g. for a new measurement.
+    """
+    if correlator is not None:
+        correlator.reset()
 
-    transferrable_bins = transferrable_samples // SAMPLES_PER_BIN
 
-    buf_idx = transfer_from
-    for _ in range(transferrable_bins):
-        green_bin = 0
-        red_bin = 0
-        for _ in range(0, SAMPLES_PER_BIN):
-            green_bin += buf[buf_idx]
-            if CHANNELS == 2:
-                red_bin += buf[buf_idx + 1]
-            buf_idx = (buf_idx + CHANNELS) % PLAIN_BUFFER_SIZE
-        # print(f"canv[{canv_idx}] = bin from {buf_idx-SAMPLES_PER_BIN*CHANNELS} to {buf_idx}")
-        pos_green[canv_idx, 1] = green_bin
-        if CHANNELS == 2:
-            pos_red[canv_idx, 1] = red_bin
-        canv_idx = (canv_idx + 1) % N
+# Live burst search, fed by the acquisition thread as well.
+# Only the histograms are kept, so memory doesn't grow with the measurement.
+burst_searcher = None
+burst_histograms = BurstHistograms()
+burst_reader = RingReader(min_chunk_size=0)
+# samples handed to burst_searcher so far (times of the photons)
+burst_samples = 0
 
-    return buf_idx, canv_idx
 
+def new_burst_searcher():
+    return BurstSearch(max_window_duration(10, BURST_RATE, 1 / ACQUISITION_RATE), min_size=BURST_MIN_SIZE)
 
-def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None, 
-              correlate=False, cross=True, auto=True):
+
+def burst_callback_fn(buf, produced):
+    """
+    Acquisition thread callback, searches bursts in new samples.
+    """
+    global burst_searcher, burst_samples
+    if burst_searcher is None:
+        return
+    lost = burst_reader.skip_overwritten(produced)
+    if lost > 0:
+        # no bursts across the gap
+        burst_histograms.add(burst_searcher.finish())
+        burst_searcher = new_burst_searcher()
+        burst_samples += lost // CHANNELS
+    for start, end in burst_reader.spans(produced):
+        counts = buf[start:end].reshape(-1, CHANNELS)
+        times, dets = proc_raw(counts)
+        burst_histograms.add(burst_searcher.add(times + burst_samples, dets))
+        burst_samples += counts.shape[0]
+
+
+def step_line(edges, hist):
+    """
+    Vertices of a histogram drawn as steps.
+    """
+    pos = np.empty((2 * hist.size, 2), dtype=np.float32)
+    pos[0::2, 0] = edges[:-1]
+    pos[1::2, 0] = edges[1:]
+    pos[0::2, 1] = hist
+    pos[1::2, 1] = hist
+    return pos
+
+
+def draw_bins():
+    """
+    Moves all published bins to the history.
+    Returns the number of bins in the history (since the start).
+    """
+    published = list()
+    while True:
+        try:
+            published.append(bins_queue.get_nowait())
+        except queue.Empty:
+            break
+    if len(published) > 0:
+        history.append(np.concatenate(published))
+    return history.count[0]
+
+
+def history_lines(x_min, x_max, max_bins):
+    """
+    Vertices of the history lines (one per channel) for bins x_min...x_max.
+    Coarser levels are drawn as zigzag between the minimum and maximum of
+    each bin, so bursts stay visible.
+    """
+    width, x, mins, maxs, means = history.view(x_min, x_max, max_bins)
+    lines = list()
+    for c in range(CHANNELS):
+        if width == 1:
+            pos = np.vstack([x, means[:, c]]).T
+        else:
+            pos = np.empty((2 * x.size, 2), dtype=np.float32)
+            pos[0::2, 0] = x - width / 4
+            pos[1::2, 0] = x + width / 4
+            pos[0::2, 1] = mins[:, c]
+            pos[1::2, 1] = maxs[:, c]
+        lines.append(pos.astype(np.float32))
+    return lines
+
+
+def visualize(buf, get_idx_fn, acquisition_fun=None, 
+              correlate=False, cross=True, auto=True, bursts=False, lost_samples_fn=None):
+    global correlator, burst_searcher
 
     if acquisition_fun is not None:
         keys = dict(space=acquisition_fun)
@@ -101,9 +194,9 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     view.camera.rect = (0, 0, CANVAS_SIZE[1], CANVAS_SIZE[0])
 
     progress_bar = scene.visuals.InfiniteLine(0, parent=view.scene)
-    green_line = scene.visuals.Line(pos=pos_green,color='g',parent=view.scene)
+    green_line = scene.visuals.Line(color='g',parent=view.scene)
     if CHANNELS == 2:
-        red_line = scene.visuals.Line(pos=pos_red,color='r',parent=view.scene)
+        red_line = scene.visuals.Line(color='r',parent=view.scene)
     gridlines = scene.GridLines(color=(1, 1, 1, 1), parent=view.scene)
 
     yax = scene.AxisWidget(orientation='left', axis_label="Counts")
@@ -115,19 +208,23 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     xax.link_view(view)
     
     if correlate:
-        corr_bins = np.logspace(np.log(1/ACQUISITION_RATE)/np.log(10), 0, 10)
-        corr_bins = (corr_bins*ACQUISITION_RATE).astype(np.int64)
+        corr_pairs = list()
+        if cross:
+            corr_pairs.append((0, 1))
+        if auto:
+            corr_pairs += [(c, c) for c in range(CHANNELS)]
+        # lags up to one second
+        correlator = MultiTauCorrelator(corr_pairs, ACQUISITION_RATE)
+        corr_tau = correlator.lags / ACQUISITION_RATE
         corr_view = grid.add_view(row=GRID_ROWS, col=1, row_span=GRID_ROWS, col_span=GRID_COLS,
                                   camera='panzoom', border_color='grey')
         corr_node = scene.Node(parent=corr_view.scene)
         corr_node.transform = scene.transforms.LogTransform(base=(10,0,0))
         colors = ('g', 'r')
-        if cross:
-            corr_pos_cross = np.vstack([corr_bins[:-1], np.zeros(corr_bins.size-1)]).T
-            corr_line_cross = scene.visuals.Line(pos=corr_pos_cross, parent=corr_node, color='b')
-        if auto:
-            corr_pos_auto = [np.vstack([corr_bins[:-1], np.zeros(corr_bins.size-1)]).T for _ in range(CHANNELS)]
-            corr_line_auto = [scene.visuals.Line(pos=cp, parent=corr_node, color=c) for cp, c in zip(corr_pos_auto, colors)]
+        # one line per entry of corr_pairs
+        corr_colors = (['b'] if cross else []) + (list(colors[:CHANNELS]) if auto else [])
+        corr_pos = [np.vstack([corr_tau, np.zeros(corr_tau.size)]).T for _ in corr_pairs]
+        corr_lines = [scene.visuals.Line(pos=cp, parent=corr_node, color=c) for cp, c in zip(corr_pos, corr_colors)]
         
         corr_gridlines = scene.GridLines(color=(1, 1, 1, 1), parent=corr_node)
     
@@ -139,27 +236,49 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
         grid.add_widget(corr_xax, 2*GRID_ROWS, 1, col_span=GRID_COLS)
         corr_xax.link_view(corr_view)
     
+    if bursts:
+        burst_searcher = new_burst_searcher()
+        # burst sizes above, proximity ratios below, right of the other views
+        burst_col = GRID_COLS + 2
+        burst_views = list()
+        for row, edges, label in ((0, burst_histograms.size_edges, "Burst size (photons)"),
+                                  (GRID_ROWS, burst_histograms.ratio_edges, "Proximity ratio E")):
+            burst_view = grid.add_view(row=row, col=burst_col, row_span=GRID_ROWS, col_span=GRID_COLS // 2,
+                                       camera='panzoom', border_color='grey')
+            burst_view.camera.rect = (0, 0, edges[-1], 1)
+            burst_line = scene.visuals.Line(pos=step_line(edges, np.zeros(edges.size - 1)),
+                                            color='y', parent=burst_view.scene)
+            burst_yax = scene.AxisWidget(orientation='left', axis_label="Bursts")
+            grid.add_widget(burst_yax, row, burst_col - 1, row_span=GRID_ROWS)
+            burst_yax.link_view(burst_view)
+            burst_xax = scene.AxisWidget(orientation='bottom', axis_label=label, tick_label_margin=15)
+            grid.add_widget(burst_xax, row + GRID_ROWS, burst_col, col_span=GRID_COLS // 2)
+            burst_xax.link_view(burst_view)
+            burst_views.append((burst_view, burst_line, edges))
+        burst_totals = [0, 0]
+
 
     auto_align_mutex = Lock()
     auto_align_awaits = False
     auto_align_start_idx = 0
     auto_align_end_idx = 0
 
-    last_transfer_idx = 0
-    last_update_idx = 0
-
     def update(ev):
-        nonlocal last_update_idx, last_transfer_idx
         nonlocal auto_align_mutex, auto_align_awaits, auto_align_start_idx, auto_align_end_idx
 
+        if stop_requested.is_set():
+            stop_requested.clear()
+            stop_fn()
+        while not error_messages.empty():
+            error_label.setText(error_messages.get_nowait())
+            error_label.show()
+
         transfer_idx = get_idx_fn()
         if transfer_idx % CHANNELS != 0:
             # transfer of 1 channel is ahead, reading that sample next time
             # this shouldn't happen but let's add it for sanity anyways
             transfer_idx -= 1  # TODO: what if more channels?
 
-        update_callback_fn(buf, transfer_idx)
-        
         if auto_align:
             if auto_align_thread is not None and not auto_align_thread.is_alive():
                 reset_auto_align_fn()
@@ -171,31 +290,42 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
                     auto_align_end_idx = transfer_idx
                     
 
-        last_transfer_idx, last_update_idx = transfer_data(buf, last_update_idx, last_transfer_idx, transfer_idx)
-
-        green_line.set_data(pos_green)
+        latest_bin = draw_bins()
+
+        if lost_samples_fn is not None:
+            lost_samples_text = f"Lost samples: {lost_samples_fn()}"
+            if lost_samples_label.text() != lost_samples_text:
+                lost_samples_label.setText(lost_samples_text)
+
+        rect = view.camera.rect
+        if follow_checkbox.isChecked():
+            # scroll with the newest data, keeping the zoom
+            rect = (latest_bin - rect.width, rect.bottom, rect.width, rect.height)
+            view.camera.rect = rect
+            rect = view.camera.rect
+        lines = history_lines(rect.left, rect.right, N)
+        green_line.set_data(lines[0])
         if CHANNELS == 2:
-            red_line.set_data(pos_red)
-        progress_bar.set_data(last_update_idx)
+            red_line.set_data(lines[1])
+        progress_bar.set_data(latest_bin)
+
+        if correlate:
+            # lags without data yet are NaN and not drawn
+            _, G = correlator.normalized()
+            for cp, cl, g in zip(corr_pos, corr_lines, G):
+                cp[:, 1] = g
+                cl.set_data(cp)
+
+        if bursts:
+            # fixed size, only copied and redrawn if bursts were added
+            for i, ((burst_view, burst_line, edges), hist) in enumerate(zip(burst_views, burst_histograms.histograms())):
+                if hist.sum() != burst_totals[i]:
+                    burst_totals[i] = hist.sum()
+                    burst_line.set_data(step_line(edges, hist))
+                    burst_view.camera.rect = (0, 0, edges[-1], max(hist.max() * 1.1, 1))
         
         scene_canvas.update()
-    
-    def update_corr(ev):
-        nonlocal last_update_idx, last_transfer_idx
-        nonlocal auto_align_mutex, auto_align_awaits, auto_align_start_idx, auto_align_end_idx
 
-        transfer_idx = get_idx_fn()
-        times = [proc_buffer(buf, transfer_idx, i, CHANNELS) for i in range(CHANNELS)]
-        if all(((t[-1] - t[0]) > corr_bins[-1]) for t in times):
-            if cross:
-                corr_pos_cross[:,1] = pcorrelate(times[0], times[1], corr_bins)
-                corr_line_cross.set_data(corr_pos_cross)
-            if auto:
-                for t, cp, cl in zip(times, corr_pos_auto, corr_line_auto):
-                    cp[:,1] = pcorrelate(t, t, corr_bins)
-                    cl.set_data(cp)
-            scene_canvas.update()
-    
 
     def auto_align_measure_fn(secs):
         nonlocal auto_align_mutex, auto_align_awaits, auto_align_start_idx, auto_align_end_idx
@@ -213,18 +343,6 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     timer = app.Timer(interval='auto')
     timer.connect(update)
     timer.start()
-    
-    if correlate:
-        corr_timer = app.Timer(interval=10)
-        corr_timer.connect(update_corr)
-        corr_timer.start()
-    
-    def update_corr_timer(t):
-        if t == 0 or t == 301:
-            corr_timer.stop()
-        else:
-            corr_timer.stop()
-            corr_timer.start(interval=t)
 
     w = QMainWindow()
     w.setWindowTitle("Noisy Lines Simulator v0.0.1")
@@ -253,10 +371,13 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     measurement_toggle_button.setCheckable(True)
     measurement_toggle_button.setChecked(False)
     measurement_toggle_button.clicked.connect(acquisition_fun)
+    # the correlation averages over the running measurement
+    measurement_toggle_button.clicked.connect(lambda checked: reset_correlation() if checked else None)
+    measurement_toggle_button.clicked.connect(lambda checked: burst_histograms.reset() if checked else None)
 
     measurement_layout.addWidget(measurement_toggle_button)
 
-    # Type (HDF5 or CSV)
+    # Type (HDF5, CSV or Raw)
     measurement_type_group = QGroupBox("Storage Type", measurement_frame)
     measurement_layout.addWidget(measurement_type_group)
 
@@ -267,6 +388,8 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     measurement_type_group_layout.addWidget(measurement_type_select_hdf5)
     measurement_type_select_csv = QRadioButton("CSV")
     measurement_type_group_layout.addWidget(measurement_type_select_csv)
+    measurement_type_select_raw = QRadioButton("Raw")
+    measurement_type_group_layout.addWidget(measurement_type_select_raw)
 
     measurement_type_select_hdf5.clicked.connect(
         lambda: set_measurement_type("HDF5")
@@ -274,6 +397,9 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     measurement_type_select_csv.clicked.connect(
         lambda: set_measurement_type("CSV")
     )
+    measurement_type_select_raw.clicked.connect(
+        lambda: set_measurement_type("Raw")
+    )
 
     measurement_settings = QGroupBox("Measurement Settings", measurement_frame)
     measurement_layout.addWidget(measurement_settings)
@@ -286,15 +412,23 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     measurement_settings_layout.addRow(measurement_settings_seconds_label, measurement_settings_seconds_input)
     
     measurement_settings_seconds_input.valueChanged.connect(set_measurement_seconds)
-    
-    if correlate:
-        measurement_settings_seconds_label = QLabel("Correlation update frequency (seconds)")
-        measurment_settings_correlateion_input = QSpinBox()
-        measurment_settings_correlateion_input.setRange(0, 300)
-        measurment_settings_correlateion_input.setValue(10)
-        measurement_settings_layout.addRow(measurement_settings_seconds_label, measurment_settings_correlateion_input)
-    
-        measurment_settings_correlateion_input.valueChanged.connect(update_corr_timer)
+
+    # Uncheck to scroll back in the history
+    follow_checkbox = QCheckBox(f"Follow live data (history: {HISTORY_SECONDS} s)")
+    follow_checkbox.setChecked(True)
+    autoalign_layout.addWidget(follow_checkbox)
+
+    # Samples lost because the ring buffer was overwritten before they were stored
+    lost_samples_label = QLabel("Lost samples: 0")
+    measurement_layout.addWidget(lost_samples_label)
+
+    # Errors of the storage or analysis (see report_error), hidden until one occurs
+    error_label = QLabel()
+    error_label.setStyleSheet("color: red")
+    error_label.setWordWrap(True)
+    error_label.hide()
+    measurement_layout.addWidget(error_label)
+    measurement_toggle_button.clicked.connect(lambda checked: error_label.hide() if checked else None)
 
     # Type selection disabled when measurement is running
     measurement_toggle_button.clicked.connect(measurement_type_group.setDisabled)
@@ -305,14 +439,12 @@ def visualize(buf, get_idx_fn, update_callback_fn, acquisition_fun=None,
     widget.layout().addWidget(scene_canvas.native, stretch=1)
     w.show()
 
-    global stop_measurement
     def stop_fn():
         print("Stop fn!")
         measurement_toggle_button.setChecked(False)
         measurement_type_group.setEnabled(True)
         measurement_settings.setEnabled(True)
 
-    stop_measurement = stop_fn
     
     def reset_auto_align_fn():
         global auto_align
@@ -358,4 +490,25 @@ def set_measurement_seconds(t):
     measurement_time_seconds = t
 
 
-stop_measurement = lambda: None
+stop_requested = Event()
+
+
+# Errors of other threads, shown by the GUI with its next frame
+error_messages = queue.Queue()
+
+
+def stop_measurement(message=None):
+    """
+    Resets the measurement controls, may be called from any thread.
+    The GUI picks the request up with its next frame and shows message.
+    """
+    if message is not None:
+        error_messages.put(message)
+    stop_requested.set()
+
+
+def report_error(message):
+    """
+    Shows message in the GUI, may be called from any thread.
+    """
+    error_messages.put(message)
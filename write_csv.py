@@ -0,0 +1,157 @@
+"""
+Fast CSV output of counter values.
+
+The files are byte-compatible with what csv.writer writes for rows of
+integers (comma separated, \\r\\n line endings), but whole blocks of samples
+are formatted at once by a compiled kernel.
+"""
+
+import queue
+import threading
+
+import numba
+import numpy as np
+
+
+@numba.jit(nopython=True)
+def _write_int(out, pos, value):
+    """
+    Writes the decimal representation of the non-negative value to out[pos:].
+    Returns the position after the last digit.
+    """
+    if value == 0:
+        out[pos] = 48  # '0'
+        return pos + 1
+    end = pos
+    v = value
+    while v > 0:
+        v //= 10
+        end += 1
+    i = end
+    while value > 0:
+        i -= 1
+        out[i] = 48 + value % 10
+        value //= 10
+    return end
+
+
+@numba.jit(nopython=True)
+def _format_rows(first_time, counts, channels, out):
+    pos = 0
+    for s in range(counts.size // channels):
+        pos = _write_int(out, pos, first_time + s)
+        for c in range(channels):
+            out[pos] = 44  # ','
+            pos = _write_int(out, pos + 1, counts[s * channels + c])
+        out[pos] = 13  # '\r'
+        out[pos + 1] = 10  # '\n'
+        pos += 2
+    return pos
+
+
+def format_rows(first_time, counts, channels):
+    """
+    Formats interleaved counts as CSV rows "time,count_0,...,count_n".
+
+    counts has to contain whole samples (channels values each),
+    the time column counts up from first_time.
+    Returns the rows as bytes.
+    """
+    counts = counts.reshape(-1)
+    samples = counts.size // channels
+    if samples == 0:
+        return b''
+    time_digits = len(str(first_time + samples))
+    count_digits = len(str(int(counts.max())))
+    out = np.empty(samples * (time_digits + channels * (count_digits + 1) + 2), dtype=np.uint8)
+    length = _format_rows(first_time, counts, channels, out)
+    return out[:length].tobytes()
+
+
+@numba.jit(nopython=True)
+def _format_table(table, out):
+    pos = 0
+    for r in range(table.shape[0]):
+        for c in range(table.shape[1]):
+            if c > 0:
+                out[pos] = 44  # ','
+                pos += 1
+            pos = _write_int(out, pos, table[r, c])
+        out[pos] = 13  # '\r'
+        out[pos + 1] = 10  # '\n'
+        pos += 2
+    return pos
+
+
+def format_table(table):
+    """
+    Formats the rows of a table of non-negative integers as CSV rows.
+    Returns the rows as bytes.
+    """
+    if table.shape[0] == 0:
+        return b''
+    digits = len(str(int(table.max())))
+    out = np.empty(table.shape[0] * (table.shape[1] * (digits + 1) + 1), dtype=np.uint8)
+    length = _format_table(table, out)
+    return out[:length].tobytes()
+
+
+class CSVWriter(threading.Thread):
+    """
+    Writes CSV rows from a background thread.
+
+    append() only copies the counts and hands them to the thread,
+    which formats and writes them to disk. At most max_blocks blocks are
+    queued, if the disk falls behind append() blocks until one is written.
+    """
+
+    def __init__(self, filename, header, channels, max_blocks=16):
+        # not a daemon, so queued blocks are written before Python exits
+        threading.Thread.__init__(self, name=f"write {filename}")
+        self.filename = filename
+        self.channels = channels
+        # (first lost sample, lost samples) of every ring buffer overrun
+        self.overruns = list()
+        self.queue = queue.Queue(maxsize=max(max_blocks, 1))
+        self.file = open(filename, 'wb')
+        self.file.write(",".join(header).encode() + b'\r\n')
+        self.start()
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            first_time, counts = block
+            self.file.write(format_rows(first_time, counts, self.channels))
+        self.file.close()
+        if len(self.overruns) > 0:
+            with open(self.overruns_filename, 'wb') as f:
+                f.write(b'first_lost_sample,lost_samples\r\n')
+                f.write(format_table(np.array(self.overruns, dtype=np.int64)))
+
+    def append(self, first_time, counts):
+        """
+        Queues counts (whole samples) with time column starting at first_time.
+        """
+        self.queue.put((first_time, np.array(counts)))
+
+    def add_overrun(self, time, samples):
+        """
+        Records that samples starting at time have been lost.
+        They show up as a gap in the time column as well.
+        """
+        self.overruns.append((time, samples))
+
+    @property
+    def overruns_filename(self):
+        return f'{self.filename}.overruns.txt'
+
+    def close(self):
+        """
+        Ends the file after the queued blocks. Returns without waiting for
+        them to be written, join() to wait until the file is complete.
+        If samples have been lost, their (first lost sample, lost samples)
+        are written to overruns_filename.
+        """
+        self.queue.put(None)
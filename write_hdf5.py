@@ -1,8 +1,13 @@
+import os
+
 import phconvert as phc
+import tables
 
 import numpy as np
 
-def write_file(timestamps, detectors, timestamps_unit, fname='measurements'):
+from traces import TraceBuilder, TRACES_GROUP
+
+def _data_dict(timestamps, detectors, timestamps_unit):
 
     """
     METADATA
@@ -52,9 +57,147 @@ def write_file(timestamps, detectors, timestamps_unit, fname='measurements'):
         setup=setup,
         identity=identity,
     )
+    return data
+
+
+def write_file(timestamps, detectors, timestamps_unit, fname='measurements'):
+    data = _data_dict(timestamps, detectors, timestamps_unit)
 
     """
     Actually saving the file
     """
     phc.hdf5.save_photon_hdf5(data, h5_fname=f'{fname}.h5', overwrite=True)
 
+
+class PhotonHDF5Writer():
+    """
+    Writes a Photon-HDF5 file while the measurement is running.
+
+    The file is created on construction with extendable (chunked)
+    photon_data/timestamps and photon_data/detectors arrays.
+    Every call to append() writes the given photons to disk,
+    so memory usage does not depend on the length of the measurement.
+    The metadata (same as write_file) is added by close().
+
+    Detector ids have to be below channels.
+    Binned counts per detector at every trace resolution (in seconds) are
+    written along with the photons to user/traces/level_<i> (shape
+    (bins, channels), bin i covering timestamps i*r...(i+1)*r-1 for the
+    resolution r in timestamp units stored in the array's resolution
+    attribute), so analysis tools don't have to bin all photons for a trace.
+    """
+
+    # same compression as phconvert uses by default
+    filters = tables.Filters(complevel=6, complib='zlib')
+
+    def __init__(self, timestamps_unit, fname='measurements', expected_photons=int(1e8),
+                 trace_resolutions=(1e-5, 1e-3, 1e-1), channels=2):
+        self.timestamps_unit = timestamps_unit
+        self.channels = channels
+        self.filename = f'{fname}.h5'
+        self.h5file = tables.open_file(self.filename, mode='w', filters=self.filters)
+        group = self.h5file.create_group('/', 'photon_data')
+        self.timestamps = self.h5file.create_earray(group, 'timestamps', atom=tables.Int64Atom(),
+                                                    shape=(0,), expectedrows=expected_photons)
+        self.detectors = self.h5file.create_earray(group, 'detectors', atom=tables.UInt8Atom(),
+                                                   shape=(0,), expectedrows=expected_photons)
+        resolutions = sorted({max(int(round(r / timestamps_unit)), 1) for r in trace_resolutions})
+        self.trace = TraceBuilder(resolutions, channels)
+        traces_group = self.h5file.create_group(os.path.dirname(TRACES_GROUP), os.path.basename(TRACES_GROUP),
+                                                createparents=True)
+        self.traces = list()
+        for level, resolution in enumerate(resolutions):
+            trace = self.h5file.create_earray(traces_group, f'level_{level}', atom=tables.Int32Atom(),
+                                              shape=(0, self.trace.detectors))
+            trace.attrs.resolution = resolution
+            self.traces.append(trace)
+        self.detector_counts = np.zeros(256, dtype=np.int64)
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # (first lost timestamp, lost samples) of every ring buffer overrun
+        self.overruns = list()
+
+    @property
+    def photons(self):
+        return self.timestamps.nrows
+
+    def append(self, timestamps, detectors):
+        """
+        Appends photons to the file, timestamps have to be sorted
+        and later than any photon appended before.
+        """
+        if timestamps.size == 0:
+            return
+        if detectors.max() >= self.channels:
+            # would be binned into the traces of other detectors
+            raise ValueError(f"detector {detectors.max()} of a recording of {self.channels} channels")
+        self.timestamps.append(timestamps)
+        self.detectors.append(detectors)
+        self.detector_counts += np.bincount(detectors, minlength=self.detector_counts.size)
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamps[0]
+        self.last_timestamp = timestamps[-1]
+        self.trace.add_photons(timestamps, detectors)
+        self._append_traces()
+        # don't leave compression work for close()
+        self.h5file.flush()
+
+    def _append_traces(self):
+        # bins are only finished once later photons arrived, the rows stay contiguous
+        for trace, (_, bins) in zip(self.traces, self.trace.pop_finished()):
+            if bins.shape[0] > 0:
+                trace.append(bins.astype(np.int32))
+
+    def add_overrun(self, timestamp, samples):
+        """
+        Records that samples starting at timestamp have been lost.
+        """
+        self.overruns.append((timestamp, samples))
+
+    def close(self):
+        """
+        Writes the metadata and closes the file.
+        A recording without photons is saved with a duration of 0.
+        """
+        try:
+            self._save()
+        except:
+            # don't leave a half written file open
+            if self.h5file.isopen:
+                self.h5file.close()
+            raise
+
+    def _save(self):
+        self.trace.finish()
+        self._append_traces()
+
+        data = _data_dict(self.timestamps, self.detectors, self.timestamps_unit)
+
+        # Provide everything phconvert would otherwise compute by reading
+        # all photons back from the file.
+        ids = np.flatnonzero(self.detector_counts).astype(np.uint8)
+        data['setup']['detectors'] = dict(
+            id=ids,
+            id_hardware=ids,
+            counts=self.detector_counts[ids])
+        if self.first_timestamp is None:
+            duration = 0
+        else:
+            duration = (self.last_timestamp - self.first_timestamp) * self.timestamps_unit
+        data['acquisition_duration'] = np.round(duration, 1)
+
+        overruns = np.array(self.overruns, dtype=np.int64).reshape(-1, 2)
+        data['user'] = dict(acquisition=dict(
+            lost_samples=overruns[:, 1].sum(),
+            overruns=overruns))
+
+        # Validation would read all detectors back into memory,
+        # the structure is the same as the one written by write_file.
+        phc.hdf5.save_photon_hdf5(data, h5file=self.h5file, validate=False)
+
+    def discard(self):
+        """
+        Closes and deletes the file without saving anything.
+        """
+        self.h5file.close()
+        os.remove(self.filename)